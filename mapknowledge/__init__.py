@@ -22,11 +22,18 @@ __version__ = "1.5.0"
 
 #===============================================================================
 
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+import hashlib
 import sqlite3
 import json
 import os
 from pathlib import Path
-from typing import Any, Optional
+import threading
+import time
+from typing import Any, Callable, Generator, Iterable, Iterator, Mapping, Optional
 
 #===============================================================================
 
@@ -36,10 +43,15 @@ import structlog
 
 from .anatomical_types import *
 from .apinatomy import CONNECTIVITY_ONTOLOGIES, APINATOMY_MODEL_PREFIX
+from .cache import KnowledgeCache
+from .record import KnowledgeRecord
 # from .nposparql import NpoSparql, NPO_NLP_NEURONS
-from .npo import Npo
+from .npo import Npo, local_npo_build, npo_release_build, NPO_CACHE_DIRECTORY
 from .scicrunch import SCICRUNCH_PRODUCTION, SCICRUNCH_STAGING
 from .scicrunch import SciCrunch
+from .stats import LookupStats
+from .stats import STAGE_CACHE, STAGE_COMMIT, STAGE_CONNECTIVITY_METADATA, STAGE_DATABASE
+from .stats import STAGE_NPO, STAGE_SCICRUNCH, STAGE_WRITE
 
 try:
     from mapmaker.utils import log as logger    # pyright: ignore[reportMissingImports]
@@ -53,7 +65,117 @@ KNOWLEDGE_BASE = 'knowledgebase.db'
 
 #===============================================================================
 
-SCHEMA_VERSION = '1.4'
+# Yields batches of entities to look up in SCKAN and is sent their knowledge,
+# returning the knowledge of the entities requested
+
+type KnowledgeLookup = Generator[list[str], dict[str, dict], dict[str, dict]]
+
+#===============================================================================
+
+# SQLite tuning profiles, selected when a knowledge base is constructed
+
+SQLITE_SERVING_PROFILE = 'serving'
+SQLITE_BULK_LOAD_PROFILE = 'bulk-load'
+
+SQLITE_PROFILES = {
+    # Read-mostly access by map servers
+    SQLITE_SERVING_PROFILE: {
+        'journal_mode': 'wal',              # Only set when opened for writing
+        'synchronous': 'normal',
+        'mmap_size': 1024*1024*1024,        # 1 GB
+        'cache_size': -64*1024,             # 64 MB (negative values are in KB)
+        'temp_store': 'memory',
+    },
+    # Loading and restoring knowledge sources
+    SQLITE_BULK_LOAD_PROFILE: {
+        'journal_mode': 'wal',              # Reset to `delete` on close
+        'synchronous': 'off',
+        'cache_size': -256*1024,            # 256 MB
+        'temp_store': 'memory',
+    },
+}
+
+#===============================================================================
+
+SCHEMA_VERSION = '1.12'
+
+# Scalar knowledge fields are held in their own columns of the ``knowledge`` table.
+# Remaining fields form a payload that is stored once, in the ``knowledge_payloads``
+# table, under the hash of its content, with the ``knowledge`` rows of all entities
+# having the same payload referring to it by hash. A payload's connectivity edges and
+# lists of path nodes are held in the ``path_edges`` and ``path_nodes`` tables, with
+# its other fields saved as JSON, with empty lists as placeholders for path edges and
+# nodes.
+#
+# Path nodes are saved once, as compact JSON, in the ``nodes`` table, with path edges
+# and nodes, and the ``connectivity_nodes`` and ``connectivity_terms`` tables, referring
+# to them by their integer id.
+
+KNOWLEDGE_COLUMNS = {
+    'label': 'label',
+    'long-label': 'long_label',
+    'type': 'type',
+}
+PATH_EDGES_FIELD = 'connectivity'
+PATH_NODES_FIELDS = ['axons', 'dendrites', 'somas', 'axon-terminals', 'afferent-terminals', 'axon-locations', 'nerves']
+NODE_PHENOTYPES_FIELD = 'node-phenotypes'
+
+KNOWLEDGE_ROW_COLUMNS = 'source, entity, label, long_label, type, knowledge, hash'
+KNOWLEDGE_ROWS = 'knowledge join knowledge_payloads using (hash)'
+
+# Full-text index of entity labels. Its rows are those of the ``knowledge`` table,
+# maintained by triggers, and so it must be rebuilt whenever ``knowledge`` rowids
+# change, e.g. by ``VACUUM``.
+
+# Only changes to labels need to update the index
+
+KNOWLEDGE_LABELS_UPDATE_TRIGGER = """
+    create trigger knowledge_labels_update after update of label, long_label on knowledge begin
+        insert into knowledge_labels (knowledge_labels, rowid, label, long_label)
+            values ('delete', old.rowid, old.label, old.long_label);
+        insert into knowledge_labels (rowid, label, long_label) values (new.rowid, new.label, new.long_label);
+    end;
+"""
+
+KNOWLEDGE_LABELS_SCHEMA = f"""
+    create virtual table knowledge_labels using fts5(label, long_label,
+                    content='knowledge', content_rowid='rowid', prefix='2 3');
+    create trigger knowledge_labels_insert after insert on knowledge begin
+        insert into knowledge_labels (rowid, label, long_label) values (new.rowid, new.label, new.long_label);
+    end;
+    create trigger knowledge_labels_delete after delete on knowledge begin
+        insert into knowledge_labels (knowledge_labels, rowid, label, long_label)
+            values ('delete', old.rowid, old.label, old.long_label);
+    end;
+    {KNOWLEDGE_LABELS_UPDATE_TRIGGER}
+"""
+
+# Number of rows read at a time when iterating over stored knowledge
+STREAM_CHUNK_SIZE = 1000
+
+# Number of entities saved between commits when bulk loading knowledge
+BULK_LOAD_COMMIT_EVERY = 1000
+
+# Seconds before an entity that SCKAN doesn't know about is looked up again
+UNKNOWN_ENTITY_TTL = 7*24*60*60
+
+# Marks knowledge from a SCKAN lookup that didn't get an answer, because
+# NPO or SciCrunch wasn't available or a request failed
+SCKAN_UNANSWERED = 'sckan-unanswered'
+
+# When a store loads NPO: while being created, at first use, or in a background thread
+NPO_LOAD_NOW = 'now'
+NPO_LOAD_LAZY = 'lazy'
+NPO_LOAD_BACKGROUND = 'background'
+
+# Kinds of entity that can be preloaded into a store's cache
+PRELOAD_TERMS = 'terms'
+PRELOAD_PATHS = 'paths'
+
+PRELOAD_CONDITIONS = {
+    PRELOAD_TERMS: "json_type(knowledge, '$.connectivity') is null",
+    PRELOAD_PATHS: "json_type(knowledge, '$.connectivity') is not null",
+}
 
 ## Have auto update to remove any ``-npo`` suffix on ``source`` column values.
 
@@ -72,20 +194,137 @@ SCHEMA_VERSION = '1.4'
 KNOWLEDGE_SCHEMA = f"""
     create table metadata (name text primary key, value text);
 
-    create table knowledge (source text, entity text, knowledge text);
+    create table knowledge (source text, entity text, label text, long_label text, type text, verified real,
+                            hash text);
     create unique index knowledge_index on knowledge(source, entity);
+    create index knowledge_hash_index on knowledge(hash);
+
+    create table knowledge_payloads (hash text primary key, knowledge text);
+
+    create table nodes (id integer primary key, node text);
+    create unique index nodes_index on nodes(node);
+
+    create table path_edges (hash text, seq integer, node_from integer, node_to integer);
+    create index path_edges_index on path_edges(hash, seq);
+
+    create table path_nodes (hash text, field text, phenotype text, seq integer, node integer);
+    create index path_nodes_index on path_nodes(hash, field, phenotype, seq);
 
     create table connectivity_models (model text primary key, version text);
 
     create table pmr_models (term text, score number, model text, workspace text, exposure text);
     create index pmr_models_term_index on pmr_models(term, score);
 
-    create table connectivity_nodes (source text, node text, path text);
+    create table connectivity_nodes (source text, node integer, path text);
     create unique index connectivity_nodes_index on connectivity_nodes(source, node, path);
 
+    create table connectivity_terms (term text, source text, path text, node integer, layer integer);
+    create unique index connectivity_terms_index on connectivity_terms(term, source, layer, path, node);
+    create index connectivity_terms_path_index on connectivity_terms(source, path);
+
+    {KNOWLEDGE_LABELS_SCHEMA}
+
+    create table unknown_entities (source text, entity text, checked real);
+    create unique index unknown_entities_index on unknown_entities(source, entity);
+
     insert into metadata (name, value) values ('schema_version', '{SCHEMA_VERSION}');
 """
 
+def canonical_order(items: Iterable) -> list:
+#============================================
+    """
+    Sort path edges or nodes by their compact JSON encoding.
+
+    NPO and SciCrunch build a path's edges and node lists from sets, so their order
+    has no meaning and differs between processes.
+    """
+    return sorted(items, key=lambda item: json.dumps(item, separators=(',', ':')))
+
+def canonical_knowledge(knowledge: dict) -> dict:
+#================================================
+    """
+    A copy of knowledge with its connectivity edges and lists of path nodes
+    in canonical order.
+    """
+    canonical = dict(knowledge)
+    for field in [PATH_EDGES_FIELD, *PATH_NODES_FIELDS]:
+        if isinstance(items := canonical.get(field), (list, tuple)):
+            canonical[field] = canonical_order(items)
+    if isinstance(phenotypes := canonical.get(NODE_PHENOTYPES_FIELD), dict):
+        canonical[NODE_PHENOTYPES_FIELD] = {phenotype: canonical_order(nodes) for phenotype, nodes in phenotypes.items()}
+    return canonical
+
+def knowledge_hash(knowledge_json: dict, edges: Optional[list|tuple],
+                   node_lists: Mapping[tuple[str, Optional[str]], list|tuple]) -> str:
+#====================================================================================
+    """
+    The hash of a knowledge payload's content.
+
+    :param  knowledge_json: The payload's JSON fields, with placeholders for path edges and nodes
+    :param  edges:          The payload's connectivity edges, if any, in canonical order
+    :param  node_lists:     The payload's lists of path nodes, indexed by field and phenotype,
+                            with each list in canonical order
+    :returns:               A hexadecimal SHA-256 digest
+    """
+    # Empty node lists have no rows in ``path_nodes`` so aren't part of the hash
+    nodes = sorted([[field, phenotype, nodes] for (field, phenotype), nodes in node_lists.items() if len(nodes)],
+                   key=lambda node_list: (node_list[0], node_list[1] or ''))
+    content = json.dumps([knowledge_json, edges, nodes], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def upgrade_content_addressed(db: sqlite3.Connection):
+#=====================================================
+    """
+    Upgrade a knowledge base from schema version 1.9 to 1.10, storing each distinct
+    knowledge payload, and its path edges and nodes, once under its content hash.
+    """
+    db.executescript("""
+        create table knowledge_payloads (hash text primary key, knowledge text);
+        create table path_edges_copy (hash text, seq integer, node_from text, node_to text);
+        create table path_nodes_copy (hash text, field text, phenotype text, seq integer, node text);
+        alter table knowledge add hash text;
+    """)
+    payload_hashes = set()
+    for (rowid, source, entity, payload) in db.execute('select rowid, source, entity, knowledge from knowledge').fetchall():
+        knowledge_json = json.loads(payload)
+        edges = None
+        if isinstance(knowledge_json.get(PATH_EDGES_FIELD), list):
+            edges = canonical_order([json.loads(row[0]), json.loads(row[1])]
+                        for row in db.execute('''select node_from, node_to from path_edges
+                                                    where source is ? and path=?''', (source, entity)))
+        node_lists: dict[tuple[str, Optional[str]], list] = defaultdict(list)
+        for row in db.execute('''select field, phenotype, node from path_nodes
+                                    where source is ? and path=?''', (source, entity)):
+            node_lists[(row[0], row[1])].append(json.loads(row[2]))
+        for nodes in node_lists.values():
+            nodes[:] = canonical_order(nodes)
+        payload_hash = knowledge_hash(knowledge_json, edges, node_lists)
+        if payload_hash not in payload_hashes:
+            payload_hashes.add(payload_hash)
+            db.execute('insert into knowledge_payloads (hash, knowledge) values (?, ?)', (payload_hash, payload))
+            if edges is not None:
+                db.executemany('insert into path_edges_copy (hash, seq, node_from, node_to) values (?, ?, ?, ?)',
+                                [(payload_hash, seq, json.dumps(edge[0]), json.dumps(edge[1]))
+                                    for seq, edge in enumerate(edges)])
+            db.executemany('insert into path_nodes_copy (hash, field, phenotype, seq, node) values (?, ?, ?, ?, ?)',
+                            [(payload_hash, field, phenotype, seq, json.dumps(node))
+                                for (field, phenotype), nodes in node_lists.items()
+                                    for seq, node in enumerate(nodes)])
+        db.execute('update knowledge set hash=? where rowid=?', (payload_hash, rowid))
+    db.executescript("""
+        drop table path_edges;
+        alter table path_edges_copy rename to path_edges;
+        create index path_edges_index on path_edges(hash, seq);
+        drop table path_nodes;
+        alter table path_nodes_copy rename to path_nodes;
+        create index path_nodes_index on path_nodes(hash, field, phenotype, seq);
+        alter table knowledge drop column knowledge;
+        create index knowledge_hash_index on knowledge(hash);
+        replace into metadata (name, value) values ('schema_version', '1.10');
+    """)
+
+# Upgrades are either an SQL script or a function, called with the database connection
+
 SCHEMA_UPGRADES = {
     None: ('1.1', """
         alter table connectivity_models add version text;
@@ -111,6 +350,125 @@ SCHEMA_UPGRADES = {
         drop table labels;
         drop table publications;
         replace into metadata (name, value) values ('schema_version', '1.4');
+    """),
+    '1.4': ('1.5', """
+        create table path_edges (source text, path text, seq integer, node_from text, node_to text);
+        insert into path_edges (source, path, seq, node_from, node_to)
+            select k.source, k.entity, e.key, json_extract(e.value, '$[0]'), json_extract(e.value, '$[1]')
+                from knowledge k, json_each(k.knowledge, '$.connectivity') e;
+        create index path_edges_index on path_edges(source, path, seq);
+
+        create table path_nodes (source text, path text, field text, phenotype text, seq integer, node text);
+        insert into path_nodes (source, path, field, phenotype, seq, node)
+            select k.source, k.entity, f.key, null, n.key, n.value
+                from knowledge k, json_each(k.knowledge) f, json_each(f.value) n
+                where f.type = 'array' and f.key in ('axons', 'dendrites', 'somas', 'axon-terminals',
+                                                     'afferent-terminals', 'axon-locations', 'nerves');
+        insert into path_nodes (source, path, field, phenotype, seq, node)
+            select k.source, k.entity, 'node-phenotypes', p.key, n.key, n.value
+                from knowledge k, json_each(k.knowledge, '$."node-phenotypes"') p, json_each(p.value) n
+                where p.type = 'array';
+        create index path_nodes_index on path_nodes(source, path, field, phenotype, seq);
+
+        create table knowledge_copy (source text, entity text, label text, long_label text, type text, knowledge text);
+        insert into knowledge_copy (source, entity, label, long_label, type, knowledge)
+            select source, entity,
+                   json_extract(knowledge, '$.label'),
+                   json_extract(knowledge, '$."long-label"'),
+                   json_extract(knowledge, '$.type'),
+                   json_replace(json_remove(knowledge, '$.label', '$."long-label"', '$.type', '$.source'),
+                        '$.connectivity', json('[]'),
+                        '$.axons', json('[]'),
+                        '$.dendrites', json('[]'),
+                        '$.somas', json('[]'),
+                        '$."axon-terminals"', json('[]'),
+                        '$."afferent-terminals"', json('[]'),
+                        '$."axon-locations"', json('[]'),
+                        '$.nerves', json('[]'),
+                        '$."node-phenotypes"', (select json_group_object(p.key, json('[]'))
+                                                    from json_each(knowledge, '$."node-phenotypes"') p))
+                from knowledge;
+        drop table knowledge;
+        alter table knowledge_copy rename to knowledge;
+        create unique index knowledge_index on knowledge(source, entity);
+        replace into metadata (name, value) values ('schema_version', '1.5');
+    """),
+    '1.5': ('1.6', """
+        create table connectivity_terms (term text, source text, path text, node text, layer integer);
+        create unique index connectivity_terms_index on connectivity_terms(term, source, layer, path, node);
+        create index connectivity_terms_path_index on connectivity_terms(source, path);
+        insert or ignore into connectivity_terms (term, source, path, node, layer)
+            select json_extract(node, '$[0]'), source, path, node, 0 from connectivity_nodes;
+        insert or ignore into connectivity_terms (term, source, path, node, layer)
+            select l.value, c.source, c.path, c.node, 1
+                from connectivity_nodes c, json_each(c.node, '$[1]') l;
+        replace into metadata (name, value) values ('schema_version', '1.6');
+    """),
+    '1.6': ('1.7', f"""
+        {KNOWLEDGE_LABELS_SCHEMA}
+        insert into knowledge_labels (knowledge_labels) values ('rebuild');
+        replace into metadata (name, value) values ('schema_version', '1.7');
+    """),
+    '1.7': ('1.8', """
+        create table unknown_entities (source text, entity text, checked real);
+        create unique index unknown_entities_index on unknown_entities(source, entity);
+        replace into metadata (name, value) values ('schema_version', '1.8');
+    """),
+    '1.8': ('1.9', """
+        alter table knowledge add verified real;
+        replace into metadata (name, value) values ('schema_version', '1.9');
+    """),
+    '1.9': ('1.10', upgrade_content_addressed),
+    '1.10': ('1.11', """
+        create table nodes (id integer primary key, node text);
+        create unique index nodes_index on nodes(node);
+        insert into nodes (node)
+            select json(node_from) from path_edges
+            union select json(node_to) from path_edges
+            union select json(node) from path_nodes
+            union select json(node) from connectivity_nodes
+            union select json(node) from connectivity_terms;
+
+        create table path_edges_copy (hash text, seq integer, node_from integer, node_to integer);
+        insert into path_edges_copy (hash, seq, node_from, node_to)
+            select e.hash, e.seq, f.id, t.id from path_edges e
+                join nodes f on f.node = json(e.node_from)
+                join nodes t on t.node = json(e.node_to);
+        drop table path_edges;
+        alter table path_edges_copy rename to path_edges;
+        create index path_edges_index on path_edges(hash, seq);
+
+        create table path_nodes_copy (hash text, field text, phenotype text, seq integer, node integer);
+        insert into path_nodes_copy (hash, field, phenotype, seq, node)
+            select p.hash, p.field, p.phenotype, p.seq, n.id from path_nodes p
+                join nodes n on n.node = json(p.node);
+        drop table path_nodes;
+        alter table path_nodes_copy rename to path_nodes;
+        create index path_nodes_index on path_nodes(hash, field, phenotype, seq);
+
+        create table connectivity_nodes_copy (source text, node integer, path text);
+        insert into connectivity_nodes_copy (source, node, path)
+            select distinct c.source, n.id, c.path from connectivity_nodes c
+                join nodes n on n.node = json(c.node);
+        drop table connectivity_nodes;
+        alter table connectivity_nodes_copy rename to connectivity_nodes;
+        create unique index connectivity_nodes_index on connectivity_nodes(source, node, path);
+
+        create table connectivity_terms_copy (term text, source text, path text, node integer, layer integer);
+        insert into connectivity_terms_copy (term, source, path, node, layer)
+            select distinct c.term, c.source, c.path, n.id, c.layer from connectivity_terms c
+                join nodes n on n.node = json(c.node);
+        drop table connectivity_terms;
+        alter table connectivity_terms_copy rename to connectivity_terms;
+        create unique index connectivity_terms_index on connectivity_terms(term, source, layer, path, node);
+        create index connectivity_terms_path_index on connectivity_terms(source, path);
+
+        replace into metadata (name, value) values ('schema_version', '1.11');
+    """),
+    '1.11': ('1.12', f"""
+        drop trigger knowledge_labels_update;
+        {KNOWLEDGE_LABELS_UPDATE_TRIGGER}
+        replace into metadata (name, value) values ('schema_version', '1.12');
     """)
 }
 
@@ -146,11 +504,21 @@ def clean_knowledge_source(source: str) -> str:
 
 
 class KnowledgeBase(object):
-    def __init__(self, store_directory, read_only=False, create=False, knowledge_base=KNOWLEDGE_BASE):
+    def __init__(self, store_directory, read_only=False, create=False, knowledge_base=KNOWLEDGE_BASE, threaded=False,
+                       profile: Optional[str]=None):
         logger = structlog.get_logger(logger_name)
         self.__logger = logger.bind(type='knowledge')
         self.__db = None
         self.__read_only = read_only
+        if profile is not None and profile not in SQLITE_PROFILES:
+            raise ValueError(f'Unknown knowledge base profile: `{profile}`')
+        self.__profile = profile
+        # A threaded knowledge base has a read-only connection for each thread that uses it
+        if threaded and not read_only:
+            raise ValueError('A threaded knowledge base must be opened read only')
+        self.__threaded = threaded
+        self.__thread_connections: dict[int, sqlite3.Connection] = {}
+        self.__connection_lock = threading.Lock()
         if store_directory is None:
             self.__db_name = None
         else:
@@ -172,6 +540,13 @@ class KnowledgeBase(object):
     @property
     def db(self) -> Optional[sqlite3.Connection]:
     #============================================
+        if self.__threaded and self.__db is not None:
+            thread_id = threading.get_ident()
+            with self.__connection_lock:
+                if (db := self.__thread_connections.get(thread_id)) is None:
+                    db = self.__connect(read_only=True)
+                    self.__thread_connections[thread_id] = db
+            return db
         return self.__db
 
     @property
@@ -184,24 +559,70 @@ class KnowledgeBase(object):
     #==================================
         return str(self.__db_name) if self.__db_name is not None else None
 
+    @property
+    def profile(self) -> Optional[str]:
+    #==================================
+        return self.__profile
+
     @property
     def read_only(self) -> bool:
     #===========================
         return self.__read_only
 
+    @property
+    def threaded(self) -> bool:
+    #==========================
+        return self.__threaded
+
     def close(self):
     #===============
+        with self.__connection_lock:
+            for db in self.__thread_connections.values():
+                if db is not self.__db:
+                    db.close()
+            self.__thread_connections = {}
         if self.__db is not None:
+            if self.__profile == SQLITE_BULK_LOAD_PROFILE and not self.__read_only:
+                # Leave a self-contained database file for copying to servers
+                self.__db.commit()
+                self.__set_pragmas(self.__db, {'journal_mode': 'delete'})
             self.__db.close()
             self.__db = None
 
+    def __connect(self, read_only: bool) -> sqlite3.Connection:
+    #==========================================================
+        assert self.__db_name is not None
+        db_uri = f'{self.__db_name.as_uri()}?mode=ro' if read_only else self.__db_name.as_uri()
+        # Threaded connections may be closed by a thread other than the one using them
+        db = sqlite3.connect(db_uri, uri=True, autocommit=False, check_same_thread=not self.__threaded,
+                             detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        if self.__profile is not None:
+            pragmas = SQLITE_PROFILES[self.__profile]
+            if read_only:
+                # The journal mode of a database can't be changed by a read-only connection
+                pragmas = {name: value for name, value in pragmas.items() if name != 'journal_mode'}
+            self.__set_pragmas(db, pragmas)
+        return db
+
+    def __set_pragmas(self, db: sqlite3.Connection, pragmas: dict[str, str|int]):
+    #=============================================================================
+        # Some pragmas can't be set within a transaction
+        db.autocommit = True
+        try:
+            for name, value in pragmas.items():
+                db.execute(f'pragma {name}={value}')
+        finally:
+            db.autocommit = False
+
     def open(self, read_only: bool=False):
     #=====================================
         self.close()
         if self.__db_name is not None:
-            db_uri = f'{self.__db_name.as_uri()}?mode=ro' if read_only else self.__db_name.as_uri()
-            self.__db = sqlite3.connect(db_uri, uri=True, autocommit=False,
-                                        detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            if self.__threaded and not read_only:
+                raise ValueError('A threaded knowledge base must be opened read only')
+            self.__db = self.__connect(read_only)
+            if self.__threaded:
+                self.__thread_connections[threading.get_ident()] = self.__db
             if self.__db is not None:
                 if (schema_version := self.metadata('schema_version')) != SCHEMA_VERSION:
                     if read_only:
@@ -212,7 +633,10 @@ class KnowledgeBase(object):
                         self.log.warning(f'Upgrading knowledge base schema from version {schema_version} to {upgrade[0]}')
                         schema_version = upgrade[0]
                         try:
-                            self.__db.executescript(upgrade[1])
+                            if callable(upgrade[1]):
+                                upgrade[1](self.__db)
+                            else:
+                                self.__db.executescript(upgrade[1])
                         except sqlite3.Error as e:
                             self.__db.rollback()
                             raise ValueError(f'Unable to upgrade knowledge base schema to version {schema_version}: {str(e)}')
@@ -220,16 +644,71 @@ class KnowledgeBase(object):
 
     def metadata(self, name: str) -> Optional[str]:
     #==============================================
-        if self.__db is not None:
-            row = self.__db.execute('select value from metadata where name=?', (name,)).fetchone()
+        if (db := self.db) is not None:
+            row = db.execute('select value from metadata where name=?', (name,)).fetchone()
             if row is not None:
                 return row[0]
 
     def set_metadata(self, name: str, value: str):
     #=============================================
-        if self.__db is not None:
-            self.__db.execute('replace into metadata values (?, ?)', (name,value))
-            self.__db.commit()
+        if (db := self.db) is not None:
+            db.execute('replace into metadata values (?, ?)', (name,value))
+            db.commit()
+
+    def vacuum_into(self, database_file: str|Path):
+    #===============================================
+        """
+        Save a compacted copy of the knowledge base, including any committed changes.
+
+        :param  database_file:  The file to create. It must not already exist
+        """
+        if (db := self.db) is not None:
+            db.commit()
+            # ``VACUUM`` can't be run within a transaction
+            db.autocommit = True
+            try:
+                db.execute('vacuum into ?', (str(database_file),))
+            finally:
+                db.autocommit = False
+
+    def optimise(self):
+    #==================
+        """
+        Compact the knowledge base and update its query planner statistics.
+
+        The label index is rebuilt, as ``VACUUM`` may change ``knowledge`` rowids.
+        """
+        if (db := self.db) is not None:
+            if self.__read_only:
+                raise ValueError('Cannot optimise a read-only knowledge base')
+            db.commit()
+            db.autocommit = True
+            try:
+                db.execute('vacuum')
+                db.execute("insert into knowledge_labels (knowledge_labels) values ('rebuild')")
+                db.execute("insert into knowledge_labels (knowledge_labels) values ('optimize')")
+                db.execute('analyze')
+            finally:
+                db.autocommit = False
+
+#===============================================================================
+
+@dataclass
+class BulkLoad:
+    """
+    The progress of a bulk load into a knowledge store.
+
+    :param  commit_every:   The number of entities saved between commits
+    :param  committed:      The number of entities whose knowledge has been committed
+    :param  pending:        The number of saved entities waiting to be committed
+    :param  last_committed: The last entity whose knowledge was committed
+    :param  last_saved:     The last entity whose knowledge was saved
+    """
+    commit_every: int
+    committed: int = 0
+    pending: int = 0
+    last_committed: Optional[str] = None
+    last_saved: Optional[str] = None
 
 #===============================================================================
 
@@ -245,11 +724,34 @@ class KnowledgeStore(KnowledgeBase):
                        sckan_version: Optional[str]=None,
                        sckan_provenance=False,
                        use_sckan=True,
-                       verbose=True):
-        super().__init__(store_directory, create=create, knowledge_base=knowledge_base, read_only=read_only)
-        self.__entity_knowledge: dict[tuple[Optional[str], str], dict[str, Any]] = {}     # Cache lookups
+                       verbose=True,
+                       cache_entries: Optional[int]=None,
+                       cache_bytes: Optional[int]=None,
+                       cache_per_source=False,
+                       threaded=False,
+                       profile: Optional[str]=None,
+                       lazy_knowledge=False,
+                       unknown_entity_ttl: Optional[float]=UNKNOWN_ENTITY_TTL,
+                       refresh_after: Optional[float]=None,
+                       stats_interval: Optional[float]=None,
+                       npo_loading: str=NPO_LOAD_NOW,
+                       npo_cache_directory: Optional[str|Path]=NPO_CACHE_DIRECTORY,
+                       npo_offline: bool=False,
+                       npo_path: Optional[str|Path]=None):
+        super().__init__(store_directory, create=create, knowledge_base=knowledge_base, read_only=read_only,
+                         threaded=threaded, profile=profile)
+        self.__entity_knowledge = KnowledgeCache(max_entries=cache_entries,             # Cache lookups
+                                                 max_bytes=cache_bytes,
+                                                 per_source=cache_per_source)
+        self.__lazy_knowledge = lazy_knowledge
+        self.__unknown_entity_ttl = unknown_entity_ttl
+        self.__refresh_after = refresh_after
+        self.__bulk_load: Optional[BulkLoad] = None
+        self.__stats = LookupStats()
+        self.__stats_interval = stats_interval
+        self.__stats_logged = time.monotonic()
         self.__npo_entities: set[str] = set()
-        self.__sckan_provenance: dict[str, Optional[str]|dict[str, str]] = {}
+        self.__sckan_provenance: dict[str, Optional[str]|dict[str, Optional[str]]] = {}
         self.__verbose = verbose
 
         if (db_name := self.db_name) is not None:
@@ -282,23 +784,39 @@ class KnowledgeStore(KnowledgeBase):
                 release_version = 'production' if scicrunch_version == SCICRUNCH_PRODUCTION else 'staging'
                 self.log.info(f"With {release_version} SCKAN{scicrunch_build} from {self.__scicrunch.api_endpoint}")
 
-        if not read_only and use_sckan:
-            self.__npo_db = Npo(sckan_version)
-            self.__npo_entities = set(self.__npo_db.terms)
-            if sckan_provenance:
-                npo_builds = self.__npo_db.build()
-                if len(npo_builds):
-                    self.__sckan_provenance['npo'] = {
-                            'date': npo_builds['released'],
-                            'release': npo_builds['release'],
-                            'path': npo_builds['path'],
-                            'sha': npo_builds['sha']
-                    }
-                    if verbose:
-                        self.log.info(f"With NPO built at {npo_builds['released']} from {npo_builds['path']}, SHA: {npo_builds['sha']}")
-            self.__source = self.__npo_db.release
-        else:
-            self.__npo_db = None
+        self.__npo_db: Optional[Npo] = None
+        self.__npo_loader: Optional[Callable[[], Npo]] = None
+        self.__npo_error: Optional[Exception] = None
+        self.__npo_lock = threading.Lock()
+        self.__use_npo = not read_only and use_sckan
+        if self.__use_npo:
+            if npo_loading not in [NPO_LOAD_NOW, NPO_LOAD_LAZY, NPO_LOAD_BACKGROUND]:
+                raise ValueError(f'Unknown `npo_loading`: `{npo_loading}`')
+            # The release needs to be checked when it isn't given, or for provenance,
+            # otherwise it's checked when NPO is loaded. A local release is never checked
+            npo_cache = Path(npo_cache_directory) if npo_cache_directory is not None else None
+            if npo_path is not None:
+                npo_path = Path(npo_path)
+                npo_builds = local_npo_build(npo_path, sckan_version)
+            else:
+                npo_builds = (npo_release_build(sckan_version, cache_directory=npo_cache, offline=npo_offline)
+                                if (sckan_version is None or sckan_provenance) else None)
+            self.__npo_loader = partial(Npo, sckan_version, npo_builds, cache_directory=npo_cache,
+                                        offline=npo_offline, npo_path=npo_path)
+            if npo_loading == NPO_LOAD_NOW:
+                self.__npo()
+            elif npo_loading == NPO_LOAD_BACKGROUND:
+                threading.Thread(target=self.__load_npo, name='npo-load', daemon=True).start()
+            if sckan_provenance and npo_builds:
+                self.__sckan_provenance['npo'] = {
+                        'date': npo_builds['released'],
+                        'release': npo_builds['release'],
+                        'path': npo_builds['path'],
+                        'sha': npo_builds['sha']
+                }
+                if verbose:
+                    self.log.info(f"With NPO built at {npo_builds['released']} from {npo_builds['path']}, SHA: {npo_builds['sha']}")
+            self.__source = sckan_version if npo_builds is None else npo_builds['release']
 
         if self.__source is None and self.db:
             known_sources= self.knowledge_sources()
@@ -323,6 +841,63 @@ class KnowledgeStore(KnowledgeBase):
         if self.db is not None:
             self.__clean_source_suffix()
 
+    @contextmanager
+    def bulk_load(self, commit_every: int=BULK_LOAD_COMMIT_EVERY) -> Iterator[BulkLoad]:
+    #===================================================================================
+        """
+        Group knowledge saved by the store into large transactions.
+
+        Within the context, knowledge is committed after every ``commit_every`` entities
+        are saved and when the context exits, instead of after each request. Should the
+        context fail then uncommitted knowledge is rolled back and the number of entities
+        already committed is logged.
+
+        :param  commit_every:   The number of entities saved between commits
+        :returns:               The load's progress
+        """
+        if self.db is None or self.read_only:
+            raise ValueError('Bulk loading requires a writable knowledge store')
+        if self.__bulk_load is not None:
+            raise ValueError('A bulk load is already in progress')
+        if commit_every < 1:
+            raise ValueError('`commit_every` must be at least 1')
+        bulk_load = BulkLoad(commit_every)
+        self.__bulk_load = bulk_load
+        try:
+            yield bulk_load
+        except BaseException:
+            self.db.rollback()
+            if bulk_load.committed:
+                self.log.error(f'Bulk load failed after committing {bulk_load.committed} entities (last was `{bulk_load.last_committed}`); '
+                               f'{bulk_load.pending} uncommitted entities rolled back')
+            else:
+                self.log.error(f'Bulk load failed; {bulk_load.pending} uncommitted entities rolled back')
+            bulk_load.pending = 0
+            raise
+        else:
+            self.__checkpoint(bulk_load)
+        finally:
+            self.__bulk_load = None
+
+    def __checkpoint(self, bulk_load: BulkLoad):
+    #===========================================
+        with self.__stats.timer(STAGE_COMMIT):
+            self.db.commit()    # type: ignore
+        bulk_load.committed += bulk_load.pending
+        bulk_load.pending = 0
+        bulk_load.last_committed = bulk_load.last_saved
+
+    def __commit(self):
+    #==================
+        # Commits are deferred to checkpoints when bulk loading
+        if self.__bulk_load is None:
+            with self.__stats.timer(STAGE_COMMIT):
+                self.db.commit()    # type: ignore
+
+    @property
+    def cache(self) -> KnowledgeCache:
+        return self.__entity_knowledge
+
     @property
     def source(self):
         return self.__source
@@ -331,6 +906,63 @@ class KnowledgeStore(KnowledgeBase):
     def sckan_provenance(self):
         return self.__sckan_provenance
 
+    def stats(self, reset: bool=False) -> dict[str, dict[str, int|float]]:
+    #=====================================================================
+        """
+        Counts and latencies of the stages of knowledge lookups.
+
+        Stages are the memory cache (``cache``), the local database (``database``),
+        ``Npo.get_knowledge`` (``npo``), ``SciCrunch.get_knowledge`` (``scicrunch``),
+        ``SciCrunch.connectivity_metadata`` (``connectivity-metadata``), saving knowledge
+        (``write``), and commits (``commit``). Stages that haven't been timed are omitted.
+
+        :param  reset:  Start new counts once statistics have been obtained
+        :returns:       A dictionary, indexed by stage, with the stage's ``count``, and its
+                        ``total``, ``mean``, ``max``, ``p50``, ``p90`` and ``p99`` latencies,
+                        in seconds
+        """
+        stats = self.__stats.stats()
+        if reset:
+            self.__stats.reset()
+        return stats
+
+    def log_stats(self, reset: bool=False):
+    #======================================
+        """
+        Log lookup statistics, as returned by :meth:`stats`, along with
+        the memory cache's statistics.
+
+        Statistics are also logged every ``stats_interval`` seconds, at the end
+        of a lookup, when the store was created with a ``stats_interval``.
+        """
+        self.__stats_logged = time.monotonic()
+        self.log.info('Knowledge lookup statistics', stages=self.stats(reset=reset), cache=self.__entity_knowledge.stats())
+
+    def __npo(self) -> Optional[Npo]:
+    #================================
+        # Load NPO if it hasn't yet been loaded, waiting for any load in progress
+        if self.__npo_loader is not None:
+            self.__load_npo()
+        if self.__npo_error is not None:
+            raise self.__npo_error
+        return self.__npo_db
+
+    def __load_npo(self):
+    #====================
+        with self.__npo_lock:
+            if self.__npo_loader is not None:
+                if self.__verbose:
+                    self.log.info('Loading NPO...')
+                try:
+                    npo_db = self.__npo_loader()
+                    self.__npo_entities = set(npo_db.terms)
+                    self.__npo_db = npo_db
+                except Exception as e:
+                    self.log.error(f'Cannot load NPO: {e}')
+                    self.__npo_error = e
+                finally:
+                    self.__npo_loader = None
+
     def __log_errors(self, entity: str, knowledge: dict):
     #==============================================
         for error in knowledge.get('errors', []):
@@ -344,18 +976,27 @@ class KnowledgeStore(KnowledgeBase):
             namespaces = [f'{APINATOMY_MODEL_PREFIX}%']
             namespaces.extend([f'{ontology}:%' for ontology in CONNECTIVITY_ONTOLOGIES])
             condition = ' or '.join(len(namespaces)*['entity like ?'])
-            params = [knowledge_source] + namespaces
-            self.db.execute(f'delete from knowledge where (source=? or source is null) and ({condition})', tuple(params))
-            connectivity_terms = set()
-            for row in self.db.execute(
-                    f'select distinct node from connectivity_nodes where source=? or source is null', (knowledge_source,)).fetchall():
-                node = json.loads(row[0])
-                connectivity_terms.update([node[0]] + list(node[1]))
-            connectivity_entities = list(connectivity_terms)
-            condition = ', '.join(len(connectivity_entities)*'?')
-            self.db.execute(f'delete from knowledge where (source=? or source is null) and entity in ({condition})',
-                                                            tuple([knowledge_source] + connectivity_entities))
-            self.db.execute(f'delete from connectivity_nodes where source=? or source is null', (knowledge_source,))
+            try:
+                # Stage connectivity models, paths, and the terms used by connectivity nodes
+                self.db.execute('create temp table if not exists connectivity_entities (entity text primary key)')
+                self.db.execute('delete from temp.connectivity_entities')
+                self.db.execute(f'''insert or ignore into temp.connectivity_entities (entity)
+                                        select entity from knowledge where (source=? or source is null) and ({condition})''',
+                                                            tuple([knowledge_source] + namespaces))
+                self.db.execute('''insert or ignore into temp.connectivity_entities (entity)
+                                        select term from connectivity_terms
+                                            where source=? or source is null''', (knowledge_source,))
+                # And then delete them as a single transaction
+                self.db.execute('''delete from knowledge where (source=? or source is null)
+                                        and entity in (select entity from temp.connectivity_entities)''', (knowledge_source,))
+                for table in ['connectivity_nodes', 'connectivity_terms']:
+                    self.db.execute(f'delete from {table} where source=? or source is null', (knowledge_source,))
+                self.db.execute('drop table temp.connectivity_entities')
+                self.__delete_unused_payloads()
+                self.__delete_unused_nodes()
+            except sqlite3.Error:
+                self.db.rollback()
+                raise
             self.db.commit()
 
     ### Is this still relevanty???
@@ -366,8 +1007,8 @@ class KnowledgeStore(KnowledgeBase):
 
         :returns:   A list of model URIs
         """
-        if self.__npo_db is not None:
-            return self.__npo_db.connectivity_models
+        if (npo_db := self.__npo()) is not None:
+            return npo_db.connectivity_models
         else:
             self.log.warning('NPO connectivity models requested but no connection to NPO service')
         return []
@@ -379,110 +1020,612 @@ class KnowledgeStore(KnowledgeBase):
 
         :returns:   A list of path URIs
         """
-        if self.__npo_db is not None:
-            return self.__npo_db.connectivity_paths
+        if (npo_db := self.__npo()) is not None:
+            return npo_db.connectivity_paths
         else:
             self.log.warning('NPO connectivity paths requested but no connection to NPO service')
         return []
 
     def entities(self) -> list[str]:
     #===============================
-        if self.__npo_db is not None:
-            return self.__npo_db.terms
+        if (npo_db := self.__npo()) is not None:
+            return npo_db.terms
         else:
             self.log.warning('NPO terms requested but no connection to NPO service')
         return []
 
     def entities_of_type(self, anatomical_type: str) -> list[str]:
     #=============================================================
-        if self.__npo_db is not None:
-            return self.__npo_db.terms_of_type(anatomical_type)
+        if (npo_db := self.__npo()) is not None:
+            return npo_db.terms_of_type(anatomical_type)
         else:
             self.log.warning('NPO terms requested but no connection to NPO service')
         return []
 
-    def entity_knowledge(self, entity: str, source: Optional[str]=None) -> dict:
-    #===========================================================================
+    def entity_knowledge(self, entity: str, source: Optional[str]=None, refresh: bool=False) -> dict:
+    #===============================================================================================
+        return self.entity_knowledge_many([entity], source=source, refresh=refresh)[entity]
+
+    def entity_knowledge_many(self, entities: Iterable[str], source: Optional[str]=None,
+                              refresh: bool=False) -> dict[str, dict]:
+    #======================================================================================
+        """
+        Get knowledge about a number of entities.
+
+        Cached knowledge is used when available, with all remaining entities
+        looked up in the local database with a single query. Entities that are
+        not known locally are then looked up in SCKAN, along with any terms
+        used by their connectivity, with all knowledge saved in a single
+        transaction.
+
+        Stored knowledge of an entity whose label is the entity itself is looked
+        up again only if it has never been verified against SCKAN, or it was
+        verified more than ``refresh_after`` seconds ago.
+
+        :param  entities:   The entities to get knowledge for
+        :param  source:     The knowledge source to use. Defaults to the store's source
+        :param  refresh:    Look up all the entities in SCKAN, ignoring cached and
+                            stored knowledge. Only used when the store has a SCKAN connection
+        :returns:           A dictionary, indexed by entity, with the same knowledge
+                            as :meth:`entity_knowledge` returns for each entity
+        """
+        lookup = self.knowledge_lookup(entities, source=source, refresh=refresh)
+        try:
+            entities = next(lookup)
+            while True:
+                entities = lookup.send({entity: self.sckan_entity_knowledge(entity) for entity in entities})
+        except StopIteration as result:
+            return result.value
+
+    def knowledge_lookup(self, entities: Iterable[str], source: Optional[str]=None,
+                         refresh: bool=False) -> KnowledgeLookup:
+    #===============================================================================
+        """
+        Get knowledge about a number of entities, as :meth:`entity_knowledge_many`
+        does, leaving the caller to look up entities in SCKAN.
+
+        The generator yields batches of entities that need to be looked up in SCKAN,
+        and must be sent a dictionary with each entity's knowledge, as returned by
+        :meth:`sckan_entity_knowledge`. Lookups may be made concurrently, but all
+        other use of the generator must be from the thread that uses the store.
+
+        :param  entities:   The entities to get knowledge for
+        :param  source:     The knowledge source to use. Defaults to the store's source
+        :param  refresh:    Look up all the entities in SCKAN
+        :returns:           A generator that returns the same dictionary as
+                            :meth:`entity_knowledge_many`
+        """
         use_source = self.__source if source is None else clean_knowledge_source(source)
+        entity_knowledge: dict[str, dict] = {}
+        refresh = (refresh and (source is None or source == self.__source)
+                           and (self.__use_npo or self.__scicrunch is not None))
 
         # Check local cache
-        if (knowledge := self.__entity_knowledge.get((use_source, entity))) is not None:
-            self.__log_errors(entity, knowledge)
-            return knowledge
-
-        knowledge = {}
-        if self.db is not None:
+        lookups = []
+        for entity in dict.fromkeys(entities):
+            if refresh:
+                lookups.append(entity)
+            else:
+                start = time.perf_counter()
+                knowledge = self.__entity_knowledge.get((use_source, entity))
+                self.__stats.record(STAGE_CACHE, time.perf_counter() - start)
+                if knowledge is not None:
+                    self.__log_errors(entity, knowledge)
+                    entity_knowledge[entity] = knowledge
+                else:
+                    lookups.append(entity)
+
+        if len(lookups):
             # Check our database
-            if use_source is not None:
-                row = self.db.execute(
-                    'select source, knowledge from knowledge where source=? and entity=? order by source desc',
-                                                                            (use_source, entity)).fetchone()
+            with self.__stats.timer(STAGE_DATABASE):
+                stored_knowledge = self.__stored_entity_knowledge(lookups, use_source)
+
+            if refresh:
+                stored_knowledge.update((yield from self.__sckan_knowledge(lookups, refresh=True)))
+            elif source is None or source == self.__source:
+                # Check SCKAN for entities we don't have knowledge or a valid label for
+                sckan_entities = self.__unverified_entities(lookups, stored_knowledge)
+                if len(sckan_entities):
+                    stored_knowledge.update((yield from self.__sckan_knowledge(sckan_entities)))
+
+            for entity in lookups:
+                knowledge = stored_knowledge.get(entity, {})
+                self.__cache_knowledge(entity, knowledge)
+                entity_knowledge[entity] = knowledge
+
+        if (self.__stats_interval is not None
+        and time.monotonic() - self.__stats_logged >= self.__stats_interval):
+            self.log_stats()
+        return entity_knowledge
+
+    def __stored_entity_knowledge(self, entities: list[str], source: Optional[str]) -> dict[str, dict]:
+    #==================================================================================================
+        stored_knowledge = {}
+        if self.db is not None:
+            # Entities are passed as a JSON array to avoid SQLite's limit on the number of parameters
+            if source is not None:
+                rows = self.db.execute(f'''select {KNOWLEDGE_ROW_COLUMNS} from {KNOWLEDGE_ROWS}
+                                            where source=? and entity in (select value from json_each(?))''',
+                                                                    (source, json.dumps(entities))).fetchall()
             else:
-                row = self.db.execute('select source, knowledge from knowledge where entity=? order by source desc',
-                                                                            (entity,)).fetchone()
+                rows = self.db.execute(f'''select {KNOWLEDGE_ROW_COLUMNS} from {KNOWLEDGE_ROWS}
+                                            where entity in (select value from json_each(?))
+                                            order by entity, source desc''',
+                                                                    (json.dumps(entities),)).fetchall()
+            first_rows = {}
+            for row in rows:
+                if row[1] not in first_rows:
+                    first_rows[row[1]] = row
+            stored_knowledge = dict(zip(first_rows.keys(), self.__knowledge_from_rows(list(first_rows.values()))))
+        return stored_knowledge
+
+    def __knowledge_from_rows(self, rows: list[tuple]) -> list[dict]:
+    #================================================================
+        """
+        Assemble knowledge from rows of the ``knowledge`` table and their payloads,
+        selected as ``KNOWLEDGE_ROW_COLUMNS``, together with any path edges and nodes.
+
+        If the store is using lazy knowledge then a :class:`KnowledgeRecord` is
+        returned for each row.
+        """
+        assert self.db is not None
+        if self.__lazy_knowledge:
+            return [self.__knowledge_record(row) for row in rows]
+        knowledge_list = []
+        path_knowledge: dict[str, list[dict]] = defaultdict(list)      # Indexed by payload hash
+        for row in rows:
+            knowledge = json.loads(row[5])
+            for field, value in zip(KNOWLEDGE_COLUMNS.keys(), row[2:5]):
+                if value is not None:
+                    knowledge[field] = value
+            knowledge['source'] = row[0]
+            if any(field in knowledge for field in [PATH_EDGES_FIELD, NODE_PHENOTYPES_FIELD, *PATH_NODES_FIELDS]):
+                path_knowledge[row[6]].append(knowledge)
+            knowledge_list.append(knowledge)
+        if len(path_knowledge):
+            payload_hashes = json.dumps(list(path_knowledge.keys()))
+            for row in self.db.execute('''select e.hash, f.node, t.node from path_edges e
+                                            join nodes f on f.id = e.node_from join nodes t on t.id = e.node_to
+                                            where e.hash in (select value from json_each(?))
+                                            order by e.hash, e.seq''', (payload_hashes,)):
+                edge = [json.loads(row[1]), json.loads(row[2])]
+                for knowledge in path_knowledge[row[0]]:
+                    knowledge[PATH_EDGES_FIELD].append(edge)
+            for row in self.db.execute('''select p.hash, p.field, p.phenotype, n.node from path_nodes p
+                                            join nodes n on n.id = p.node
+                                            where p.hash in (select value from json_each(?))
+                                            order by p.hash, p.field, p.phenotype, p.seq''', (payload_hashes,)):
+                node = json.loads(row[3])
+                for knowledge in path_knowledge[row[0]]:
+                    if row[2] is None:
+                        knowledge[row[1]].append(node)
+                    else:
+                        knowledge[row[1]][row[2]].append(node)
+        return knowledge_list
+
+    def __knowledge_record(self, row: tuple) -> KnowledgeRecord:
+    #===========================================================
+        fields = {field: value for field, value in zip(KNOWLEDGE_COLUMNS.keys(), row[2:5])
+                                if value is not None}
+        fields['source'] = row[0]
+        return KnowledgeRecord(fields, row[5],
+                               deferred=[PATH_EDGES_FIELD, NODE_PHENOTYPES_FIELD, *PATH_NODES_FIELDS],
+                               loader=partial(self.__load_path_field, row[6]))
+
+    def __load_path_field(self, payload_hash: str, field: str, placeholder: Any) -> Any:
+    #===================================================================================
+        assert self.db is not None
+        if field == PATH_EDGES_FIELD and placeholder == []:
+            return [[json.loads(row[0]), json.loads(row[1])]
+                        for row in self.db.execute('''select f.node, t.node from path_edges e
+                                                        join nodes f on f.id = e.node_from
+                                                        join nodes t on t.id = e.node_to
+                                                        where e.hash=? order by e.seq''', (payload_hash,))]
+        elif field == NODE_PHENOTYPES_FIELD and isinstance(placeholder, dict):
+            for row in self.db.execute('''select p.phenotype, n.node from path_nodes p join nodes n on n.id = p.node
+                                            where p.hash=? and p.field=? order by p.phenotype, p.seq''',
+                                        (payload_hash, field)):
+                placeholder.setdefault(row[0], []).append(json.loads(row[1]))
+        elif field in PATH_NODES_FIELDS and placeholder == []:
+            return [json.loads(row[0])
+                        for row in self.db.execute('''select n.node from path_nodes p join nodes n on n.id = p.node
+                                                        where p.hash=? and p.field=? and p.phenotype is null
+                                                        order by p.seq''', (payload_hash, field))]
+        return placeholder
+
+    def store_entity_knowledge(self, entity: str, knowledge: dict, source: Optional[str]=None,
+                               verified: Optional[float]=None):
+    #=========================================================================================
+        """
+        Save an entity's knowledge in the local database.
+
+        The knowledge's payload is only saved if the database doesn't already hold
+        an identical payload.
+
+        The caller is responsible for committing the transaction, unless a
+        :meth:`bulk_load` is in progress, when knowledge is committed periodically.
+
+        :param  entity:     The entity
+        :param  knowledge:  The entity's knowledge
+        :param  source:     The knowledge source to save under. Defaults to the store's source
+        :param  verified:   When the knowledge was obtained from SCKAN, as seconds since the epoch
+        """
+        if self.db is None:
+            return
+        with self.__stats.timer(STAGE_WRITE):
+            self.__save_entity_knowledge(entity, knowledge, source, verified)
+        # Any cached knowledge is out of date, and may have a deleted payload
+        self.__entity_knowledge.discard((self.__source if source is None else clean_knowledge_source(source), entity))
+        if (bulk_load := self.__bulk_load) is not None:
+            bulk_load.pending += 1
+            bulk_load.last_saved = entity
+            if bulk_load.pending >= bulk_load.commit_every:
+                self.__checkpoint(bulk_load)
+
+    def __save_entity_knowledge(self, entity: str, knowledge: dict, source: Optional[str],
+                                verified: Optional[float]):
+    #=====================================================================================
+        assert self.db is not None
+        source = self.__source if source is None else clean_knowledge_source(source)
+        knowledge_json = {field: value for field, value in knowledge.items()
+                            if field not in KNOWLEDGE_COLUMNS and field != 'source'}
+        # Edges and nodes are saved in canonical order, so that a path's hash doesn't
+        # depend on the order NPO happened to give them in
+        edges = knowledge_json.get(PATH_EDGES_FIELD)
+        if isinstance(edges, (list, tuple)):
+            edges = canonical_order(edges)
+            knowledge_json[PATH_EDGES_FIELD] = []
+        node_lists: dict[tuple[str, Optional[str]], list|tuple] = {}
+        for field in PATH_NODES_FIELDS:
+            if isinstance(nodes := knowledge_json.get(field), (list, tuple)):
+                node_lists[(field, None)] = canonical_order(nodes)
+                knowledge_json[field] = []
+        if isinstance(phenotypes := knowledge_json.get(NODE_PHENOTYPES_FIELD), dict):
+            for phenotype, nodes in phenotypes.items():
+                node_lists[(NODE_PHENOTYPES_FIELD, phenotype)] = canonical_order(nodes)
+            knowledge_json[NODE_PHENOTYPES_FIELD] = {phenotype: [] for phenotype in phenotypes}
+
+        if not isinstance(edges, (list, tuple)):
+            edges = None
+        payload_hash = knowledge_hash(knowledge_json, edges, node_lists)
+        row = self.db.execute('select hash from knowledge where source=? and entity=?', (source, entity)).fetchone()
+
+        # Replace as a delete and insert, so that the label index's triggers fire
+        self.db.execute('delete from knowledge where source=? and entity=?', (source, entity))
+        self.db.execute('''insert into knowledge (source, entity, label, long_label, type, verified, hash)
+                                values (?, ?, ?, ?, ?, ?, ?)''',
+                            (source, entity, *[knowledge.get(field) for field in KNOWLEDGE_COLUMNS],
+                             verified, payload_hash))
+        if self.db.execute('select 1 from knowledge_payloads where hash=?', (payload_hash,)).fetchone() is None:
+            self.db.execute('insert into knowledge_payloads (hash, knowledge) values (?, ?)',
+                                                            (payload_hash, json.dumps(knowledge_json)))
+            if edges is not None:
+                self.db.executemany('insert into path_edges (hash, seq, node_from, node_to) values (?, ?, ?, ?)',
+                                    [(payload_hash, seq, self.__node_id(edge[0]), self.__node_id(edge[1]))
+                                        for seq, edge in enumerate(edges)])
+            self.db.executemany('insert into path_nodes (hash, field, phenotype, seq, node) values (?, ?, ?, ?, ?)',
+                                [(payload_hash, field, phenotype, seq, self.__node_id(node))
+                                    for (field, phenotype), nodes in node_lists.items()
+                                        for seq, node in enumerate(nodes)])
+        if row is not None and row[0] != payload_hash:
+            self.__delete_unused_payloads([row[0]])
+
+        for table in ['connectivity_nodes', 'connectivity_terms']:
+            self.db.execute(f'delete from {table} where source=? and path=?', (source, entity))
+        self.db.execute('delete from unknown_entities where source=? and entity=?', (source, entity))
+        if edges is not None:
+            seen_nodes = set()
+            for edge in edges:
+                for node in edge:
+                    node = (node[0], tuple(node[1]))
+                    if node not in seen_nodes:
+                        seen_nodes.add(node)
+                        node_id = self.__node_id(node)
+                        self.db.execute('replace into connectivity_nodes (source, node, path) values (?, ?, ?)',
+                                                                    (source, node_id, entity))
+                        self.db.executemany('''insert or ignore into connectivity_terms (term, source, path, node, layer)
+                                                    values (?, ?, ?, ?, ?)''',
+                                            ((term, source, entity, node_id, int(layer))
+                                                for layer, terms in enumerate([node[:1], node[1]])
+                                                    for term in terms))
+
+    def __node_id(self, node: Any) -> int:
+    #=====================================
+        # The id of a path node, interning the node if it's new
+        assert self.db is not None
+        node_json = json.dumps(node, separators=(',', ':'))
+        if (row := self.db.execute('select id from nodes where node=?', (node_json,)).fetchone()) is not None:
+            return row[0]
+        return self.db.execute('insert into nodes (node) values (?)', (node_json,)).lastrowid    # type: ignore
+
+    def purge_knowledge(self, source: str):
+    #======================================
+        """
+        Delete all knowledge held for a knowledge source.
+
+        The caller is responsible for committing the transaction.
+        """
+        if self.db is not None:
+            for table in ['knowledge', 'connectivity_nodes', 'connectivity_terms', 'unknown_entities']:
+                self.db.execute(f'delete from {table} where source=?', (source, ))
+            self.__delete_unused_payloads()
+            self.__delete_unused_nodes()
+
+    def delete_knowledge(self, entity: str, source: Optional[str]=None):
+    #===================================================================
+        """
+        Delete an entity's knowledge from the local database.
+
+        The caller is responsible for committing the transaction.
+
+        :param  entity:     The entity
+        :param  source:     The knowledge source to delete from. Defaults to the store's source
+        """
+        if self.db is not None:
+            source = self.__source if source is None else clean_knowledge_source(source)
+            row = self.db.execute('select hash from knowledge where source=? and entity=?', (source, entity)).fetchone()
+            self.db.execute('delete from knowledge where source=? and entity=?', (source, entity))
+            for table in ['connectivity_nodes', 'connectivity_terms']:
+                self.db.execute(f'delete from {table} where source=? and path=?', (source, entity))
             if row is not None:
-                knowledge = json.loads(row[1])
-                knowledge['source'] = row[0]
+                self.__delete_unused_payloads([row[0]])
+            self.__entity_knowledge.discard((source, entity))
 
-        if ((len(knowledge) == 0 or entity == knowledge.get('label', entity))
-        and (source is None or source == self.__source)):
-            # We don't have knowledge or a valid label for the entity so check SCKAN
-            ontology = entity.split(':')[0]
+    def copy_knowledge(self, from_source: str, to_source: str):
+    #==========================================================
+        """
+        Copy all knowledge held for a knowledge source to another source.
 
-            # Always first consult NPO
-            if self.__verbose:
-                self.log.info(f'Consulting NPO for knowledge about {entity}')
-            if self.__npo_db:
-                knowledge = self.__npo_db.get_knowledge(entity)
-
-            # If NPO doesn't know about the entity and its not connectivity
-            # related we consult SciCrunch
-            if (len(knowledge) == 1 and self.__scicrunch is not None
-            and not (entity in self.__npo_entities or ontology in CONNECTIVITY_ONTOLOGIES)):
-                if self.__verbose:
-                    self.log.info(f'Consulting SciCrunch for knowledge about {entity}')
-                knowledge = self.__scicrunch.get_knowledge(entity)
-                if 'connectivity' in knowledge:
-                    # Get phenotype, taxon, and other metadata
-                    knowledge.update(self.__scicrunch.connectivity_metadata(entity))
+        Knowledge payloads are shared by the sources, so only the rows that refer to
+        them are copied. Existing knowledge of ``to_source`` is replaced.
+
+        The caller is responsible for committing the transaction.
+        """
+        if self.db is not None:
+            to_source = clean_knowledge_source(to_source)
+            if to_source == from_source:
+                return
+            self.purge_knowledge(to_source)
+            self.db.execute('''insert into knowledge (source, entity, label, long_label, type, verified, hash)
+                                select ?, entity, label, long_label, type, verified, hash
+                                    from knowledge where source=?''', (to_source, from_source))
+            self.db.execute('''insert or ignore into connectivity_nodes (source, node, path)
+                                select ?, node, path from connectivity_nodes where source=?''', (to_source, from_source))
+            self.db.execute('''insert or ignore into connectivity_terms (term, source, path, node, layer)
+                                select term, ?, path, node, layer from connectivity_terms where source=?''',
+                                                                                    (to_source, from_source))
+
+    def __delete_unused_payloads(self, payload_hashes: Optional[list[str]]=None):
+    #============================================================================
+        # Delete payloads, and their path edges and nodes, that no entity refers to,
+        # optionally only checking the given payloads
+        assert self.db is not None
+        if payload_hashes is not None:
+            condition = 'hash in (select value from json_each(?)) and'
+            params: tuple = (json.dumps(payload_hashes),)
+        else:
+            condition = ''
+            params = ()
+        self.db.execute('create temp table if not exists unused_payloads (hash text primary key)')
+        self.db.execute('delete from temp.unused_payloads')
+        self.db.execute(f'''insert into temp.unused_payloads (hash)
+                                select hash from knowledge_payloads p where {condition}
+                                    not exists (select 1 from knowledge k where k.hash = p.hash)''', params)
+        for table in ['knowledge_payloads', 'path_edges', 'path_nodes']:
+            self.db.execute(f'delete from {table} where hash in (select hash from temp.unused_payloads)')
+        self.db.execute('drop table temp.unused_payloads')
+
+    def __delete_unused_nodes(self):
+    #===============================
+        assert self.db is not None
+        self.db.execute('''delete from nodes where id not in (
+                                select node_from from path_edges union select node_to from path_edges
+                                union select node from path_nodes union select node from connectivity_nodes)''')
+
+    def source_knowledge(self, source: str) -> list[dict]:
+    #=====================================================
+        """
+        Get all knowledge held for a knowledge source.
+
+        :returns:   A list of knowledge, with each entity identified by its ``id`` field
+        """
+        source_knowledge = []
+        if self.db is not None:
+            rows = self.db.execute(f'select {KNOWLEDGE_ROW_COLUMNS} from {KNOWLEDGE_ROWS} where source=?',
+                                                                                            (source,)).fetchall()
+            for row, knowledge in zip(rows, self.__knowledge_from_rows(rows)):
+                knowledge['id'] = row[1]
+                source_knowledge.append(knowledge)
+        return source_knowledge
+
+    def __sckan_knowledge(self, entities: list[str], refresh: bool=False) -> KnowledgeLookup:
+    #=======================================================================================
+        """
+        Get knowledge about entities from SCKAN, saving it in our database.
+
+        Entities are yielded a batch at a time, to be looked up by the caller.
+
+        Terms used by the connectivity of paths are queued and, if we don't already
+        have knowledge about them, also looked up, a batch at a time. All knowledge
+        is saved as a single transaction, unless a bulk load is in progress.
 
-            knowledge['source'] = self.__source
-            if len(knowledge) > 1 and self.db is not None and not self.read_only:
-                # Use 'long-label' if the entity's label' is the same as itself.
-                if 'label' in knowledge:
-                    if knowledge['label'] == entity and 'long-label' in knowledge:
-                        knowledge['label'] = knowledge['long-label']                # Save knowledge in our database
-                self.db.execute('replace into knowledge (source, entity, knowledge) values (?, ?, ?)',
-                                                    (self.__source, entity, json.dumps(knowledge)))
-                connectivity_terms = set()
-                if 'connectivity' in knowledge:
-                    seen_nodes = set()
-                    for edge in knowledge['connectivity']:
+        Entities that SCKAN answers it doesn't know about are recorded, and, unless ``refresh``
+        is set, not looked up again until ``unknown_entity_ttl`` seconds have passed.
+        """
+        sckan_knowledge = {}
+        requested_entities = set(entities)
+        queued_entities = set(entities)
+        pending_entities = list(entities)
+        saving = self.db is not None and not self.read_only
+        while len(pending_entities):
+            connectivity_terms = []
+            unknown_entities = (self.__recorded_unknown_entities(pending_entities)
+                                    if saving and not refresh else set())
+            refresh = False     # Only requested entities are refreshed
+            lookups = [entity for entity in pending_entities if entity not in unknown_entities]
+            lookup_knowledge = (yield lookups) if len(lookups) else {}
+            verified = time.time()
+            for entity in pending_entities:
+                knowledge: dict
+                if entity in unknown_entities:
+                    knowledge = {'source': self.__source}
+                else:
+                    knowledge = lookup_knowledge[entity]
+                    # Lookups may be shared, so don't change their knowledge
+                    if not (answered := SCKAN_UNANSWERED not in knowledge):
+                        knowledge = {field: value for field, value in knowledge.items() if field != SCKAN_UNANSWERED}
+                    # Only note what SCKAN said it doesn't know about
+                    if saving and answered and set(knowledge).issubset({'id', 'source'}):
+                        # Note when any knowledge we have was last checked
+                        self.db.execute('update knowledge set verified=? where source=? and entity=?',    # type: ignore
+                                                                    (verified, self.__source, entity))
+                        if self.__unknown_entity_ttl:
+                            self.db.execute('replace into unknown_entities (source, entity, checked) values (?, ?, ?)',    # type: ignore
+                                                                    (self.__source, entity, verified))
+                if saving and not set(knowledge).issubset({'id', 'source'}):
+                    self.__use_long_label(entity, knowledge)
+                    # Save knowledge in our database
+                    self.store_entity_knowledge(entity, knowledge, self.__source, verified=verified)
+                    for edge in knowledge.get('connectivity', []):
                         for node in edge:
-                            if node not in seen_nodes:
-                                seen_nodes.add(node)
-                                self.db.execute('replace into connectivity_nodes (source, node, path) values (?, ?, ?)',
-                                                                              (self.__source, json.dumps(node), entity))
-                                connectivity_terms.update([node[0]] + list(node[1]))
+                            for term in [node[0], *node[1]]:
+                                if term not in queued_entities:
+                                    queued_entities.add(term)
+                                    connectivity_terms.append(term)
+                if entity in requested_entities:
+                    sckan_knowledge[entity] = knowledge
+                else:
+                    # Knowledge about a connectivity term
+                    self.__cache_knowledge(entity, knowledge)
+            # Now make sure we have knowledge for each entity used for connectivity
+            pending_entities = self.__unknown_entities(connectivity_terms)
+
+        if saving:
+            # Finished entity updates so commit transaction
+            self.__commit()
+
+        return sckan_knowledge
+
+    def sckan_entity_knowledge(self, entity: str) -> dict:
+    #=====================================================
+        """
+        Look up an entity in SCKAN, consulting NPO and then SciCrunch.
 
-                # Finished entity specific updates so commit transaction
-                self.db.commit()
+        The knowledge is neither cached nor saved. This method makes no use of
+        the store's database and so may be called from any thread.
+
+        :param  entity: The entity
+        :returns:       The entity's knowledge, with its ``source`` set to the store's source.
+                        ``SCKAN_UNANSWERED`` is set if neither NPO nor SciCrunch could be asked
+        """
+        return self.__sckan_entity_knowledge(entity)
 
-                # Now make sure we have knowledge for each entity used for connectivity
-                for term in connectivity_terms:
-                    self.entity_knowledge(term)
+    def __use_long_label(self, entity: str, knowledge: dict):
+    #========================================================
+        # Use 'long-label' if the entity's label' is the same as itself.
+        if knowledge.get('label') == entity and 'long-label' in knowledge:
+            knowledge['label'] = knowledge['long-label']
+
+    def npo_knowledge(self, entity: str) -> dict:
+    #============================================
+        """
+        Get knowledge about an entity from NPO, as it would be saved in the store.
 
+        The knowledge is neither cached nor saved.
+
+        :param  entity: The entity
+        :returns:       The entity's NPO knowledge, or an empty dictionary if there
+                        is no connection to NPO
+        """
+        if (npo_db := self.__npo()) is None:
+            return {}
+        knowledge = npo_db.get_knowledge(entity)
+        self.__use_long_label(entity, knowledge)
+        knowledge['source'] = self.__source
+        return knowledge
+
+    def __recorded_unknown_entities(self, entities: list[str]) -> set[str]:
+    #======================================================================
+        # Entities that SCKAN didn't know about when last looked up
+        if not self.__unknown_entity_ttl or self.db is None:
+            return set()
+        return set(row[0] for row in self.db.execute('''select entity from unknown_entities
+                                                            where source is ? and checked >= ?
+                                                            and entity in (select value from json_each(?))''',
+                                (self.__source, time.time() - self.__unknown_entity_ttl, json.dumps(entities))))
+
+    def __unknown_entities(self, entities: list[str]) -> list[str]:
+    #==============================================================
+        # Entities we have no knowledge or a valid label for
+        lookups = [entity for entity in entities
+                    if self.__entity_knowledge.get((self.__source, entity)) is None]
+        stored_knowledge = self.__stored_entity_knowledge(lookups, self.__source)
+        unknown_entities = self.__unverified_entities(lookups, stored_knowledge)
+        for entity in set(lookups).difference(unknown_entities):
+            self.__cache_knowledge(entity, stored_knowledge[entity])
+        return unknown_entities
+
+    def __unverified_entities(self, entities: list[str], stored_knowledge: dict[str, dict]) -> list[str]:
+    #====================================================================================================
+        # Entities we have no knowledge of, or that only have themselves as a label and
+        # haven't been verified against SCKAN within ``refresh_after`` seconds
+        unlabelled = set(entity for entity in entities
+                            if entity in stored_knowledge and entity == stored_knowledge[entity].get('label', entity))
+        verified = set()
+        if len(unlabelled) and self.db is not None:
+            cutoff = time.time() - self.__refresh_after if self.__refresh_after is not None else 0
+            verified = set(row[0] for row in self.db.execute('''select entity from knowledge
+                                                                    where source is ? and verified >= ?
+                                                                    and entity in (select value from json_each(?))''',
+                                                        (self.__source, cutoff, json.dumps(list(unlabelled)))))
+        return [entity for entity in entities
+                    if entity not in stored_knowledge or (entity in unlabelled and entity not in verified)]
+
+    def __cache_knowledge(self, entity: str, knowledge: dict):
+    #=========================================================
         # Use the entity's value as its label if none is defined
         if 'label' not in knowledge:
             knowledge['label'] = entity
-
         # Cache local knowledge
         if 'source' in knowledge:
-            self.__entity_knowledge[(knowledge['source'], entity)] = knowledge
-
-        # Log any errors
+            self.__entity_knowledge.put((knowledge['source'], entity), knowledge)
         self.__log_errors(entity, knowledge)
 
+    def __sckan_entity_knowledge(self, entity: str) -> dict:
+    #=======================================================
+        # We don't have knowledge or a valid label for the entity so check SCKAN
+        ontology = entity.split(':')[0]
+        knowledge = {}
+        answered = False
+
+        # Always first consult NPO
+        if self.__verbose:
+            self.log.info(f'Consulting NPO for knowledge about {entity}')
+        if (npo_db := self.__npo()) is not None:
+            with self.__stats.timer(STAGE_NPO):
+                knowledge = npo_db.get_knowledge(entity)
+            # NPO is the authority for connectivity and its terms
+            answered = (len(knowledge) > 1 or entity in self.__npo_entities
+                                           or ontology in CONNECTIVITY_ONTOLOGIES)
+
+        # If NPO doesn't know about the entity and its not connectivity
+        # related we consult SciCrunch
+        if (len(knowledge) == 1 and self.__scicrunch is not None
+        and not (entity in self.__npo_entities or ontology in CONNECTIVITY_ONTOLOGIES)):
+            if self.__verbose:
+                self.log.info(f'Consulting SciCrunch for knowledge about {entity}')
+            with self.__stats.timer(STAGE_SCICRUNCH):
+                scicrunch_knowledge = self.__scicrunch.get_knowledge(entity)
+            answered = scicrunch_knowledge is not None
+            knowledge = scicrunch_knowledge if scicrunch_knowledge is not None else {}
+            if 'connectivity' in knowledge:
+                # Get phenotype, taxon, and other metadata
+                with self.__stats.timer(STAGE_CONNECTIVITY_METADATA):
+                    knowledge.update(self.__scicrunch.connectivity_metadata(entity))
+
+        knowledge['source'] = self.__source
+        if not answered:
+            knowledge[SCKAN_UNANSWERED] = True
         return knowledge
 
     def knowledge_sources(self) -> list[str]:
@@ -496,44 +1639,215 @@ class KnowledgeStore(KnowledgeBase):
 
     def label(self, entity: str) -> str:
     #===================================
+        # Only the ``label`` column is read for stored entities with a valid label
+        if (label := self.__stored_column(entity, 'label')) is not None and label != entity:
+            return label
         knowledge = self.entity_knowledge(entity)
         return knowledge.get('label', knowledge['id'])
 
-    def labels(self) -> list[tuple[str, str]]:
-    #=========================================
-        return [(kn['id'], kn.get('label', kn['id'])) for kn in self.stored_knowledge()]
+    def entity_type(self, entity: str) -> Optional[str]:
+    #===================================================
+        if (label := self.__stored_column(entity, 'label')) is not None and label != entity:
+            return self.__stored_column(entity, 'type')
+        return self.entity_knowledge(entity).get('type')
+
+    def paths_through(self, term: str, source: Optional[str]=None, as_layer: Optional[bool]=None) -> list[str]:
+    #==========================================================================================================
+        """
+        Find the connectivity paths that have a node using an anatomical term.
+
+        :param  term:       The anatomical term
+        :param  source:     The knowledge source to search. Defaults to the store's source
+        :param  as_layer:   If ``True`` then only paths using ``term`` as a layer of a node
+                            are found, if ``False`` only paths using it as a node's region,
+                            otherwise either
+        :returns:           A sorted list of path URIs
+        """
+        if self.db is None:
+            return []
+        source = self.__source if source is None else clean_knowledge_source(source)
+        conditions = ['term=?']
+        params: list = [term]
+        if source is not None:
+            conditions.append('source=?')
+            params.append(source)
+        if as_layer is not None:
+            conditions.append('layer=?')
+            params.append(int(as_layer))
+        return [row[0] for row in self.db.execute(f'''select distinct path from connectivity_terms
+                                                        where {' and '.join(conditions)} order by path''', params)]
+
+    def search_labels(self, query: str, limit: int=20, source: Optional[str]=None) -> list[tuple[str, str]]:
+    #=======================================================================================================
+        """
+        Find entities whose label or long label contains words starting with those of a query.
+
+        :param  query:      Words to search for. Each word is matched as a prefix
+        :param  limit:      The maximum number of entities to return
+        :param  source:     The knowledge source to search. Defaults to the store's source
+        :returns:           A list of ``(entity, label)`` pairs, best matches first, with
+                            matches on ``label`` ranked above those on ``long-label``
+        """
+        words = query.split()
+        if self.db is None or len(words) == 0:
+            return []
+        source = self.__source if source is None else clean_knowledge_source(source)
+        # Quote words so that FTS5 syntax characters in a query are matched literally
+        match = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+        conditions = ['knowledge_labels match ?']
+        params: list = [match]
+        if source is not None:
+            conditions.append('k.source=?')
+            params.append(source)
+        params.append(limit)
+        return [(row[0], row[1]) for row in self.db.execute(f'''
+                    select k.entity, k.label from knowledge_labels
+                        join knowledge k on k.rowid = knowledge_labels.rowid
+                        where {' and '.join(conditions)}
+                        order by bm25(knowledge_labels, 10.0, 1.0), k.entity limit ?''', params)]
+
+    def __stored_column(self, entity: str, column: str) -> Optional[str]:
+    #====================================================================
+        if (knowledge := self.__entity_knowledge.get((self.__source, entity))) is not None:
+            return next((knowledge.get(field) for field, field_column in KNOWLEDGE_COLUMNS.items()
+                                                if field_column == column), None)
+        if self.db is not None:
+            if self.__source is not None:
+                row = self.db.execute(f'select {column} from knowledge where source=? and entity=?',
+                                                                        (self.__source, entity)).fetchone()
+            else:
+                row = self.db.execute(f'select {column} from knowledge where entity=? order by source desc',
+                                                                        (entity,)).fetchone()
+            if row is not None:
+                return row[0]
+
+    def labels(self, source: Optional[str]=None) -> list[tuple[str, str]]:
+    #=====================================================================
+        return list(self.iter_labels(source))
+
+    def iter_labels(self, source: Optional[str]=None) -> Iterator[tuple[str, str]]:
+    #==============================================================================
+        """
+        Iterate over the labels of stored entities, reading only the ``label`` column.
+
+        :param  source: The knowledge source to use. Defaults to the store's source
+        :returns:       An iterator over ``(entity, label)`` pairs, ordered by entity
+        """
+        for row in self.__iter_stored_rows('source, entity, label', source):
+            yield (row[1], row[2] if row[2] is not None else row[1])
 
     def stored_knowledge(self, source: Optional[str]=None) -> list[dict]:
     #====================================================================
-        stored_knowledge = []
+        return list(self.iter_stored_knowledge(source))
+
+    def iter_stored_knowledge(self, source: Optional[str]=None,
+                              chunk_size: int=STREAM_CHUNK_SIZE) -> Iterator[dict]:
+    #===============================================================================
+        """
+        Iterate over the knowledge of stored entities.
+
+        Rows are read from the database, and assembled into knowledge, ``chunk_size``
+        entities at a time.
+
+        :param  source:     The knowledge source to use. Defaults to the store's source
+        :param  chunk_size: The number of entities to read at a time
+        :returns:           An iterator over entity knowledge, ordered by entity
+        """
+        entity_rows = []
+        for row in self.__iter_stored_rows(KNOWLEDGE_ROW_COLUMNS, source, chunk_size, from_clause=KNOWLEDGE_ROWS):
+            entity_rows.append(row)
+            if len(entity_rows) >= chunk_size:
+                yield from self.__knowledge_from_rows(entity_rows)
+                entity_rows = []
+        if len(entity_rows):
+            yield from self.__knowledge_from_rows(entity_rows)
+
+    def preload(self, source: Optional[str]=None, kinds: Optional[Iterable[str]]=None) -> int:
+    #=========================================================================================
+        """
+        Read the knowledge of all stored entities into the store's cache, so that
+        later lookups don't need to query the database.
+
+        Knowledge is read with a single scan of the ``knowledge`` table. When the store
+        has a SCKAN connection, entities that :meth:`entity_knowledge` would look up
+        again in SCKAN are not cached.
+
+        :param  source: The knowledge source to use. Defaults to the store's source
+        :param  kinds:  Only preload these kinds of entity, ``PRELOAD_TERMS`` and/or
+                        ``PRELOAD_PATHS``. Defaults to all entities
+        :returns:       The number of entities cached
+        """
+        condition = None
+        if kinds is not None:
+            kinds = set(kinds)
+            if len(unknown := kinds.difference(PRELOAD_CONDITIONS)):
+                raise ValueError(f'Unknown kinds of entity to preload: {", ".join(sorted(unknown))}')
+            elif len(kinds) == 0:
+                return 0
+            elif len(kinds) < len(PRELOAD_CONDITIONS):
+                condition = ' or '.join(f'({PRELOAD_CONDITIONS[kind]})' for kind in sorted(kinds))
+        use_source = self.__source if source is None else clean_knowledge_source(source)
+        check_sckan = (use_source == self.__source
+                   and (self.__use_npo or self.__scicrunch is not None))
+        count = 0
+        entity_rows = []
+        for row in self.__iter_stored_rows(KNOWLEDGE_ROW_COLUMNS, use_source, condition=condition,
+                                           from_clause=KNOWLEDGE_ROWS):
+            entity_rows.append(row)
+            if len(entity_rows) >= STREAM_CHUNK_SIZE:
+                count += self.__preload_rows(entity_rows, use_source, check_sckan)
+                entity_rows = []
+        if len(entity_rows):
+            count += self.__preload_rows(entity_rows, use_source, check_sckan)
+        return count
+
+    def __preload_rows(self, rows: list[tuple], source: Optional[str], check_sckan: bool) -> int:
+    #===========================================================================================
+        entity_knowledge = {row[1]: knowledge for row, knowledge in zip(rows, self.__knowledge_from_rows(rows))}
+        if check_sckan:
+            for entity in self.__unverified_entities(list(entity_knowledge.keys()), entity_knowledge):
+                del entity_knowledge[entity]
+        for entity, knowledge in entity_knowledge.items():
+            if 'label' not in knowledge:
+                knowledge['label'] = entity
+            self.__entity_knowledge.put((source, entity), knowledge)
+        return len(entity_knowledge)
+
+    def __iter_stored_rows(self, columns: str, source: Optional[str],
+                           chunk_size: int=STREAM_CHUNK_SIZE, condition: Optional[str]=None,
+                           from_clause: str='knowledge') -> Iterator[tuple]:
+    #=======================================================================================
+        # The first row for each entity, taking the most recent source when there are several
         source = self.__source if source is None else clean_knowledge_source(source)
-        if self.db is not None:
+        if (db := self.db) is not None:
+            where = f' and ({condition})' if condition is not None else ''
             if source is not None:
-                rows = self.db.execute(
-                    'select source, entity, knowledge from knowledge where source=? or source is null order by entity, source desc',
-                                                                            (source, )).fetchall()
+                cursor = db.execute(
+                    f'select {columns} from {from_clause} where (source=? or source is null){where} order by entity, source desc',
+                                                                            (source, ))
             else:
-                rows = self.db.execute('select source, entity, knowledge from knowledge order by entity, source desc').fetchall()
+                where = f' where {condition}' if condition is not None else ''
+                cursor = db.execute(f'select {columns} from {from_clause}{where} order by entity, source desc')
             last_entity = None
-            for row in rows:
-                if row[1] != last_entity:
-                    knowledge = json.loads(row[2])
-                    knowledge['source'] = row[0]
-                    stored_knowledge.append(knowledge)
-                    last_entity = row[1]
-        return stored_knowledge
+            while len(rows := cursor.fetchmany(chunk_size)):
+                for row in rows:
+                    if row[1] != last_entity:
+                        yield row
+                        last_entity = row[1]
+            cursor.close()
 
     def __clean_source_suffix(self):
     #===============================
         assert self.db is not None
         if self.metadata('clean-source-suffix') is None:
-            self.__clean_table('knowledge', ('source', 'entity',  'knowledge'))
+            self.__clean_table('knowledge', ('source', 'entity', 'label', 'long_label', 'type', 'verified', 'hash'))
             self.__clean_table('connectivity_nodes', ('source', 'node',  'path'))
+            self.__clean_table('connectivity_terms', ('source', 'path', 'term', 'node', 'layer'))
             self.set_metadata('clean-source-suffix', '1')
             self.db.commit()
 
-    def __clean_table(self, table: str, columns: tuple[str, str, str]):
-    #==================================================================
+    def __clean_table(self, table: str, columns: tuple[str, ...]):
+    #=============================================================
         assert self.db is not None
         sources = [row[0]
                     for row in self.db.execute(f'select distinct {columns[0]} from {table}').fetchall()
@@ -541,8 +1855,8 @@ class KnowledgeStore(KnowledgeBase):
         for source in sources:
             cleaned_source = clean_knowledge_source(source)
             if source != cleaned_source:
-                self.db.execute(f"""insert into {table} {columns[0], columns[1], columns[2]}
-                    select ?, {columns[1]}, {columns[2]} from {table}
+                self.db.execute(f"""insert into {table} ({', '.join(columns)})
+                    select ?, {', '.join(columns[1:])} from {table}
                         where {columns[0]}=? and {columns[1]} not in (
                             select {columns[1]} from {table} where {columns[0]}=?)""",
                     (cleaned_source, source, cleaned_source))
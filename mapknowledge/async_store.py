@@ -0,0 +1,133 @@
+#===============================================================================
+#
+#  Flatmap viewer and annotation tools
+#
+#  Copyright (c) 2019-25  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+#===============================================================================
+
+from . import KnowledgeStore
+
+#===============================================================================
+
+# Maximum number of SCKAN lookups made at the same time
+MAX_CONCURRENT_LOOKUPS = 8
+
+#===============================================================================
+
+class AsyncKnowledgeStore:
+    """
+    An asyncio front end to a :class:`KnowledgeStore`.
+
+    Cached and stored knowledge is obtained directly from the store, on the event loop's
+    thread, while entities that need to be looked up in SCKAN are looked up concurrently
+    in an executor, so that NPO and SciCrunch requests don't block the event loop. An
+    entity is only looked up once when several requests for it are in progress.
+
+    The store must have been opened in the event loop's thread. Concurrent requests
+    share the store's transaction, so a request that fails rolls back knowledge that
+    other requests in progress have saved but not yet committed.
+
+    :param  store:              The knowledge store to use
+    :param  max_concurrency:    The maximum number of SCKAN lookups made at the same time
+    :param  executor:           The executor to make lookups in. Defaults to a thread pool
+                                with ``max_concurrency`` threads
+    """
+    def __init__(self, store: KnowledgeStore, max_concurrency: int=MAX_CONCURRENT_LOOKUPS,
+                       executor: Optional[ThreadPoolExecutor]=None):
+        if max_concurrency < 1:
+            raise ValueError('`max_concurrency` must be at least 1')
+        self.__store = store
+        self.__own_executor = executor is None
+        self.__executor = (ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='sckan-lookup')
+                            if executor is None else executor)
+        self.__max_concurrency = max_concurrency
+        self.__semaphore: Optional[asyncio.Semaphore] = None
+        self.__lookups: dict[str, asyncio.Future[dict]] = {}
+
+    @property
+    def store(self) -> KnowledgeStore:
+        return self.__store
+
+    def close(self):
+    #===============
+        """
+        Close the underlying store and shutdown the executor, if we created it.
+        """
+        if self.__own_executor:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+        self.__store.close()
+
+    async def entity_knowledge(self, entity: str, source: Optional[str]=None, refresh: bool=False) -> dict:
+    #=====================================================================================================
+        """
+        Get knowledge about an entity, as :meth:`KnowledgeStore.entity_knowledge` does.
+        """
+        return (await self.entity_knowledge_many([entity], source=source, refresh=refresh))[entity]
+
+    async def entity_knowledge_many(self, entities: Iterable[str], source: Optional[str]=None,
+                                    refresh: bool=False) -> dict[str, dict]:
+    #==========================================================================================
+        """
+        Get knowledge about a number of entities, as :meth:`KnowledgeStore.entity_knowledge_many`
+        does, looking up entities in SCKAN concurrently.
+        """
+        lookup = self.__store.knowledge_lookup(entities, source=source, refresh=refresh)
+        try:
+            entities = next(lookup)
+            while True:
+                entities = lookup.send(await self.__sckan_knowledge(entities))
+        except StopIteration as result:
+            return result.value
+        except BaseException:
+            # Don't leave uncommitted knowledge to be committed by the next request
+            if (db := self.__store.db) is not None and not self.__store.read_only:
+                db.rollback()
+            raise
+        finally:
+            lookup.close()
+
+    async def __sckan_knowledge(self, entities: list[str]) -> dict[str, dict]:
+    #=========================================================================
+        # Shielded, as a lookup may be shared with other requests
+        knowledge = await asyncio.gather(*[asyncio.shield(self.__sckan_entity_knowledge(entity))
+                                            for entity in entities])
+        return dict(zip(entities, knowledge))
+
+    def __sckan_entity_knowledge(self, entity: str) -> asyncio.Future[dict]:
+    #=======================================================================
+        # Share a lookup that is already in progress
+        if (lookup := self.__lookups.get(entity)) is None:
+            lookup = asyncio.ensure_future(self.__lookup(entity))
+            self.__lookups[entity] = lookup
+            lookup.add_done_callback(lambda _: self.__lookups.pop(entity, None))
+        return lookup
+
+    async def __lookup(self, entity: str) -> dict:
+    #=============================================
+        if self.__semaphore is None:
+            # Created here so that it belongs to the running event loop
+            self.__semaphore = asyncio.Semaphore(self.__max_concurrency)
+        async with self.__semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                                self.__executor, self.__store.sckan_entity_knowledge, entity)
+
+#===============================================================================
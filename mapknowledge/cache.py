@@ -0,0 +1,187 @@
+#===============================================================================
+#
+#  Flatmap viewer and annotation tools
+#
+#  Copyright (c) 2019-25  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from collections import OrderedDict
+import json
+import threading
+from typing import Any, Optional
+
+#===============================================================================
+
+from .record import KnowledgeRecord
+
+#===============================================================================
+
+type CacheKey = tuple[Optional[str], str]        # (source, entity)
+
+#===============================================================================
+
+class CachePartition:
+    def __init__(self, max_entries: Optional[int]=None, max_bytes: Optional[int]=None):
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__entries: OrderedDict[CacheKey, tuple[dict[str, Any], int]] = OrderedDict()
+        self.__bytes = 0
+
+    @property
+    def bytes(self) -> int:
+    #======================
+        return self.__bytes
+
+    def __len__(self) -> int:
+    #========================
+        return len(self.__entries)
+
+    def clear(self):
+    #===============
+        self.__entries.clear()
+        self.__bytes = 0
+
+    def discard(self, key: CacheKey):
+    #================================
+        if (entry := self.__entries.pop(key, None)) is not None:
+            self.__bytes -= entry[1]
+
+    def get(self, key: CacheKey) -> Optional[dict[str, Any]]:
+    #========================================================
+        if (entry := self.__entries.get(key)) is not None:
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: CacheKey, knowledge: dict[str, Any], size: int) -> int:
+    #=========================================================================
+        """
+        :returns:   The number of entries evicted to make room for the new entry
+        """
+        if (entry := self.__entries.pop(key, None)) is not None:
+            self.__bytes -= entry[1]
+        self.__entries[key] = (knowledge, size)
+        self.__bytes += size
+        evictions = 0
+        # Always keep the most recent entry, even if it exceeds the byte budget
+        while len(self.__entries) > 1 and (
+            (self.__max_entries is not None and len(self.__entries) > self.__max_entries)
+         or (self.__max_bytes is not None and self.__bytes > self.__max_bytes)):
+            (_, (_, evicted_size)) = self.__entries.popitem(last=False)
+            self.__bytes -= evicted_size
+            evictions += 1
+        return evictions
+
+#===============================================================================
+
+class KnowledgeCache:
+    """
+    A size-bounded cache of entity knowledge with least-recently-used eviction.
+
+    :param  max_entries:    The maximum number of entries held. Unbounded if ``None``
+    :param  max_bytes:      The approximate maximum size of cached knowledge, as
+                            measured by its JSON encoding. Unbounded if ``None``
+    :param  per_source:     Apply limits separately to each knowledge source, so that
+                            lookups for one source don't evict another source's entries
+
+    The cache may be shared by concurrent threads.
+    """
+    def __init__(self, max_entries: Optional[int]=None, max_bytes: Optional[int]=None, per_source: bool=False):
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__per_source = per_source
+        self.__partitions: dict[Optional[str], CachePartition] = {}
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def evictions(self) -> int:
+    #==========================
+        return self.__evictions
+
+    @property
+    def hits(self) -> int:
+    #=====================
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+    #=======================
+        return self.__misses
+
+    def __len__(self) -> int:
+    #========================
+        with self.__lock:
+            return sum(len(partition) for partition in self.__partitions.values())
+
+    def __partition(self, source: Optional[str]) -> CachePartition:
+    #==============================================================
+        partition_key = source if self.__per_source else None
+        if (partition := self.__partitions.get(partition_key)) is None:
+            partition = CachePartition(self.__max_entries, self.__max_bytes)
+            self.__partitions[partition_key] = partition
+        return partition
+
+    def clear(self):
+    #===============
+        with self.__lock:
+            self.__partitions = {}
+
+    def discard(self, key: CacheKey):
+    #================================
+        with self.__lock:
+            self.__partition(key[0]).discard(key)
+
+    def get(self, key: CacheKey) -> Optional[dict[str, Any]]:
+    #========================================================
+        with self.__lock:
+            if (knowledge := self.__partition(key[0]).get(key)) is not None:
+                self.__hits += 1
+            else:
+                self.__misses += 1
+            return knowledge
+
+    def put(self, key: CacheKey, knowledge: dict[str, Any], size: Optional[int]=None):
+    #=================================================================================
+        if size is None:
+            if self.__max_bytes is None:
+                size = 0
+            elif isinstance(knowledge, KnowledgeRecord):
+                # Don't load a record's deferred fields just to size it
+                size = knowledge.encoded_size
+            else:
+                size = len(json.dumps(knowledge))
+        with self.__lock:
+            self.__evictions += self.__partition(key[0]).put(key, knowledge, size)
+
+    def stats(self) -> dict[str, Any]:
+    #=================================
+        with self.__lock:
+            entries = sum(len(partition) for partition in self.__partitions.values())
+            size = sum(partition.bytes for partition in self.__partitions.values())
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'evictions': self.__evictions,
+            'max-entries': self.__max_entries,
+            'max-bytes': self.__max_bytes,
+            'per-source': self.__per_source,
+        }
+
+#===============================================================================
@@ -19,7 +19,10 @@
 #===============================================================================
 
 import os
+import json
 import logging
+from pathlib import Path
+import posixpath
 import tempfile
 from typing import Any, Optional
 import networkx as nx
@@ -39,12 +42,13 @@ os.environ['PYONTUTILS_ONTOLOGY_LOCAL_REPO'] = temp_directory.name
 # Suppress logging of all messages while neurondm and pyontutils are imported
 logging.disable(logging.CRITICAL+1)
 
+import neurondm.core
 from neurondm.core import Config, graphBase, NegPhenotype
 from neurondm.core import OntTerm, OntId, RDFL
 from neurondm import orders
 from neurondm.core import IntersectionOf
 
-from pyontutils.core import OntGraph, OntResIri
+from pyontutils.core import OntGraph, OntResIri, OntResPath
 from pyontutils.namespaces import rdfs, ilxtr
 
 # Renable general logging
@@ -63,7 +67,7 @@ import rdflib
 from .anatomical_types import NERVE_TYPE
 from .apinatomy import EXCLUDED_LAYERS
 from .namespaces import NAMESPACES
-from .utils import request_json, log
+from .utils import request_content, request_json, log
 
 #===============================================================================
 
@@ -82,6 +86,13 @@ NPO_TTLS = ('apinat-partial-orders',
 GEN_NEURONS_PATH = 'ttl/generated/neurons/'
 TURTLE_SUFFIX = '.ttl'
 
+# Downloaded NPO releases are cached in a directory for each release tag, holding the
+# release's ``build.json`` and a directory, named by the release's commit SHA, that
+# has the same layout as the NIF-Ontology repository
+
+NPO_CACHE_DIRECTORY = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'mapknowledge', 'npo')
+NPO_CACHE_BUILD = 'build.json'
+
 #===============================================================================
 
 NODE_PHENOTYPES = [
@@ -309,9 +320,152 @@ def get_connectivity_edges(partial_order) -> list:
 
 #===============================================================================
 
+def write_file_atomically(path: Path, content: bytes):
+#=====================================================
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        temp_path.write_bytes(content)
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+def git_head_sha(repository: Path) -> Optional[str]:
+#===================================================
+    git_directory = Path(repository, '.git')
+    if not (head_file := git_directory / 'HEAD').exists():
+        return None
+    head = head_file.read_text().strip()
+    if not head.startswith('ref: '):
+        return head
+    ref = head[5:]
+    if (ref_file := git_directory / ref).exists():
+        return ref_file.read_text().strip()
+    if (packed_refs := git_directory / 'packed-refs').exists():
+        for line in packed_refs.read_text().splitlines():
+            if line.endswith(f' {ref}'):
+                return line.split()[0]
+
+def local_npo_build(npo_path: Path, npo_release: Optional[str]) -> dict[str, Optional[str]]:
+#===========================================================================================
+    """
+    Get the build of an NPO release held in a local directory.
+
+    :param  npo_path:       A checkout of the NIF-Ontology repository, or a directory
+                            containing the release's TTL files
+    :param  npo_release:    The release's tag. Defaults to the name of the directory
+    :returns:               The release's build, as returned by :func:`npo_release_build`,
+                            with the SHA of the checkout's ``HEAD``, if it has one
+    """
+    npo_path = Path(npo_path)
+    if not npo_path.is_dir():
+        raise NPOException(f'NPO directory {npo_path} does not exist')
+    return {
+        'sha': git_head_sha(npo_path),
+        'released': None,
+        'release': npo_release if npo_release is not None else npo_path.name,
+        'path': npo_path.resolve().as_posix()
+    }
+
+def cached_npo_build(cache_directory: Path, npo_release: Optional[str]) -> Optional[dict[str, Optional[str]]]:
+#=============================================================================================================
+    """
+    Get the build of an NPO release that has been cached.
+
+    :param  cache_directory:    The directory NPO releases are cached in
+    :param  npo_release:        The release's tag. The most recent cached release is used if ``None``
+    :returns:                   The release's build, as returned by :func:`npo_release_build`,
+                                or ``None`` if the release hasn't been cached
+    """
+    if npo_release is None:
+        releases = sorted(path.parent.name for path in Path(cache_directory).glob(f'sckan-*/{NPO_CACHE_BUILD}'))
+        if len(releases) == 0:
+            return None
+        npo_release = releases[-1]
+    build_file = Path(cache_directory, npo_release, NPO_CACHE_BUILD)
+    if build_file.exists():
+        return json.loads(build_file.read_text())
+
+def npo_release_build(npo_release: Optional[str], cache_directory: Optional[Path]=None,
+                      offline: bool=False) -> dict[str, Optional[str]]:
+#======================================================================================
+    """
+    Check that an NPO release exists.
+
+    :param  npo_release:        The release's tag. The most recent release is used if ``None``
+    :param  cache_directory:    A directory to cache the release's build in
+    :param  offline:            Only use a cached build, without accessing GitHub
+    :returns:                   The release's ``release`` tag, ``released`` date, ``path`` and ``sha``
+    """
+    if offline:
+        if cache_directory is None:
+            raise NPOException('A cache directory is needed to use NPO offline')
+        if (build := cached_npo_build(cache_directory, npo_release)) is None:
+            raise NPOException(f'NPO release {npo_release or "(latest)"} is not cached in {cache_directory}')
+        return build
+    elif (response:=request_json(f'{NPO_API}/releases')) is not None:
+        releases = {r['tag_name']:r for r in response if r['tag_name'].startswith('sckan-')}
+        if npo_release is None:
+            if len(releases):
+                # Use most recent
+                npo_release = sorted(releases.keys())[-1]
+                log.warning(f'No NPO release given: used {npo_release}')
+            else:
+                raise NPOException(f'No NPO releases available')
+        elif npo_release not in releases:
+            raise NPOException(f'Unknown NPO release: {npo_release}')
+
+        release = releases[npo_release]
+        response = request_json(f'{NPO_API}/git/refs/tags/{release["tag_name"]}')
+        build = {
+            'sha': response['object']['sha'] if response is not None else None,
+            'released': release['created_at'].split('T')[0],
+            'release': release["tag_name"],
+            'path': f'{NPO_GIT}/tree/{release["tag_name"]}'
+        }
+        if cache_directory is not None:
+            write_file_atomically(Path(cache_directory, release['tag_name'], NPO_CACHE_BUILD),
+                                  json.dumps(build).encode())
+        return build
+    elif cache_directory is not None and (build := cached_npo_build(cache_directory, npo_release)) is not None:
+        log.warning(f'NPO at {NPO_API} is not available: using cached {build["release"]}')
+        return build
+    else:
+        raise NPOException(f'NPO at {NPO_API} is not available')
+
+#===============================================================================
+
 class Npo:
-    def __init__(self, npo_release: Optional[str]):
-        self.__npo_release = self.__check_npo_release(npo_release)
+    """
+    Knowledge from a release of NPO.
+
+    The release's TTL files are read from ``npo_path`` when it is given, and
+    otherwise fetched from GitHub and, when a cache directory is given, saved there
+    so that they are only fetched once. Files not in ``npo_path`` are fetched.
+
+    :param  npo_release:        The release's tag. The most recent release is used if ``None``,
+                                or the name of ``npo_path`` if it is given
+    :param  npo_build:          The result of having already called ``npo_release_build(npo_release)``,
+                                or ``local_npo_build(npo_path, npo_release)``
+    :param  cache_directory:    The directory to cache releases in, or ``None`` to not cache them
+    :param  offline:            Only use a cached release, without accessing the network
+    :param  npo_path:           A checkout of the NIF-Ontology repository at the release, or a
+                                directory containing the release's TTL files
+    """
+    def __init__(self, npo_release: Optional[str], npo_build: Optional[dict[str, Optional[str]]]=None,
+                       cache_directory: Optional[Path]=NPO_CACHE_DIRECTORY, offline: bool=False,
+                       npo_path: Optional[Path]=None):
+        if npo_build is None:
+            npo_build = (local_npo_build(npo_path, npo_release) if npo_path is not None
+                         else npo_release_build(npo_release, cache_directory=cache_directory, offline=offline))
+        self.__npo_build = npo_build
+        self.__npo_release: str = self.__npo_build['release']     # type: ignore
+        self.__npo_path = Path(npo_path) if npo_path is not None else None
+        self.__offline = offline
+        self.__cache_path = (Path(cache_directory, self.__npo_release, self.__npo_build['sha'])
+                             if cache_directory is not None and self.__npo_build['sha'] is not None else None)
+        if offline and self.__cache_path is None and self.__npo_path is None:
+            raise NPOException(f'NPO release {self.__npo_release} can not be used offline')
         self.__rdf_graph = OntGraph()
         self.__composer_neurons = {}
         self.__neuron_knowledge = {}
@@ -344,8 +498,8 @@ class Npo:
     #============================
         return [NAMESPACES.curie(term) for term in self.__npo_terms.keys()]
 
-    def build(self) -> dict[str, str]:
-    #=================================
+    def build(self) -> dict[str, Optional[str]]:
+    #===========================================
         return self.__npo_build
 
     def terms_of_type(self, anatomical_type: str) -> list[str]:
@@ -353,32 +507,6 @@ class Npo:
         return [NAMESPACES.curie(term)
                     for term in self.__anatomical_terms_by_type.get(anatomical_type, [])]
 
-    def __check_npo_release(self, npo_release) -> str:
-    #=================================================
-        if (response:=request_json(f'{NPO_API}/releases')) is not None:
-            releases = {r['tag_name']:r for r in response if r['tag_name'].startswith('sckan-')}
-            if npo_release is None:
-                if len(releases):
-                    # Use most recent
-                    npo_release = sorted(releases.keys())[-1]
-                    log.warning(f'No NPO release given: used {npo_release}')
-                else:
-                    raise NPOException(f'No NPO releases available')
-            elif npo_release not in releases:
-                raise NPOException(f'Unknown NPO release: {npo_release}')
-
-            release = releases[npo_release]
-            response = request_json(f'{NPO_API}/git/refs/tags/{release["tag_name"]}')
-            self.__npo_build = {
-                'sha': response['object']['sha'] if response is not None else None,
-                'released': release['created_at'].split('T')[0],
-                'release': release["tag_name"],
-                'path': f'{NPO_GIT}/tree/{release["tag_name"]}'
-            }
-            return release['tag_name']
-        else:
-            raise NPOException(f'NPO at {NPO_API} is not available')
-
     def __load_knowledge_from_ttl(self):
     #===================================
         ## Following is based on github.com/tgbugs/pyontutils/blob/master/neurondm/neurondm/models/composer.py
@@ -389,26 +517,30 @@ class Npo:
 
         OntTerm.query._services = (RDFL(self.__rdf_graph, OntId),)
         for f in NPO_TTLS:
-            ori = OntResIri(f'{NPO_RAW}/{self.__npo_release}/{GEN_NEURONS_PATH}{f}{TURTLE_SUFFIX}')
+            ttl_file = f'{GEN_NEURONS_PATH}{f}{TURTLE_SUFFIX}'
             try:
-                if ori.graph is not None:
-                    [self.__rdf_graph.add(t) for t in ori.graph]
+                if (graph := self.__ttl_graph(ttl_file)) is not None:
+                    [self.__rdf_graph.add(t) for t in graph]
             except:
-                log.warning(f'Could not fetch {ori.iri} from {self.__npo_release}.')
+                log.warning(f'Could not fetch {ttl_file} from {self.__npo_release}.')
 
         for f in ('apinatomy-neuron-populations', '../../npo', '../../sparc-community-terms'):
-            p = urllib.parse.quote(GEN_NEURONS_PATH + f)
-            ori = OntResIri(f'{NPO_RAW}/{self.__npo_release}/{p}{TURTLE_SUFFIX}')
-            if ori.graph is not None:
+            if (graph := self.__ttl_graph(posixpath.normpath(f'{GEN_NEURONS_PATH}{f}{TURTLE_SUFFIX}'))) is not None:
                 [self.__rdf_graph.add((s, rdfs.label, o))
-                    for s, o in ori.graph[:rdfs.label:]]                    # type: ignore
+                    for s, o in graph[:rdfs.label:]]                        # type: ignore
                 if f != 'apinatomy-neuron-populations':
                     [self.__rdf_graph.add((s, rdfs.subClassOf, o))
-                        for s, o in ori.graph[:rdfs.subClassOf:]]           # type: ignore
+                        for s, o in graph[:rdfs.subClassOf:]]               # type: ignore
                     [self.__rdf_graph.add((s, ilxtr.hasExistingId, o))
-                        for s, o in ori.graph[:ilxtr.hasExistingId:]]       # type: ignore
-
-        config = Config('npo-connectivity')
+                        for s, o in graph[:ilxtr.hasExistingId:]]           # type: ignore
+
+        # neurondm fetches ``part-of-self.ttl`` itself, so have it use our copy
+        ont_res_iri = neurondm.core.OntResIri
+        neurondm.core.OntResIri = self.__ont_resource
+        try:
+            config = Config('npo-connectivity')
+        finally:
+            neurondm.core.OntResIri = ont_res_iri
         config.load_existing(self.__rdf_graph)
 
         for neuron in config.neurons():
@@ -417,6 +549,39 @@ class Npo:
                 composer_neuron['class'] = type(neuron).__name__
                 self.__composer_neurons[composer_neuron['id']] = composer_neuron
 
+    def __ttl_graph(self, ttl_file: str):
+    #====================================
+        # ``ttl_file`` is relative to the top of the NIF-Ontology repository
+        return self.__resource(ttl_file, f'{NPO_RAW}/{self.__npo_release}/{urllib.parse.quote(ttl_file)}').graph
+
+    def __ont_resource(self, iri: str) -> OntResIri|OntResPath:
+    #==========================================================
+        # Files from any branch of NIF-Ontology are cached with the release
+        if iri.startswith(f'{NPO_RAW}/'):
+            return self.__resource(urllib.parse.unquote(iri[len(NPO_RAW)+1:].split('/', 1)[1]), iri)
+        elif self.__offline:
+            raise FileNotFoundError(f'{iri} is not available offline')
+        return OntResIri(iri)
+
+    def __resource(self, ttl_file: str, iri: str) -> OntResIri|OntResPath:
+    #=====================================================================
+        if self.__npo_path is not None:
+            # Either a repository checkout or a directory of TTL files
+            for local_file in [self.__npo_path / ttl_file, self.__npo_path / posixpath.basename(ttl_file)]:
+                if local_file.exists():
+                    return OntResPath(local_file)
+        if self.__cache_path is None:
+            return OntResIri(iri)
+        cached_file = self.__cache_path / ttl_file
+        if not cached_file.exists():
+            # Failures are reported as they would be if the file wasn't being cached
+            if self.__offline:
+                raise FileNotFoundError(f'{ttl_file} from {self.__npo_release} is not cached')
+            if (content := request_content(iri)) is None:
+                return OntResIri(iri)
+            write_file_atomically(cached_file, content)
+        return OntResPath(cached_file)
+
     def __load_anatomical_types(self):
     #=================================
         self.__anatomical_terms_by_type = defaultdict(list)
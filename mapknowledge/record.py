@@ -0,0 +1,216 @@
+#===============================================================================
+#
+#  Flatmap viewer and annotation tools
+#
+#  Copyright (c) 2019-25  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import json
+import threading
+from typing import Any, Callable, Optional
+
+#===============================================================================
+
+type FieldLoader = Callable[[str, Any], Any]       # (field, placeholder) --> value
+
+#===============================================================================
+
+class KnowledgeRecord(dict):
+    """
+    Entity knowledge that is decoded as it is accessed.
+
+    A record starts with only its scalar fields. Its remaining JSON-encoded fields are
+    decoded the first time one of them is accessed, while fields that are marked as
+    deferred (connectivity and path nodes) are only loaded, by calling ``loader`` with
+    the field's name and JSON placeholder value, when the field itself is accessed.
+
+    Operations that need the entire record, such as ``items()``, ``values()``,
+    comparison and JSON encoding, load all deferred fields.
+
+    Records may be shared by threads, so decoding and loading are made while holding
+    the record's lock, and a field is only no longer deferred once its value is set.
+
+    :param  fields:         Scalar fields of the record
+    :param  knowledge_json: The JSON encoding of the record's other fields
+    :param  deferred:       Names of fields whose JSON values may be placeholders for
+                            values provided by ``loader``
+    :param  loader:         Called to get the value of a deferred field from its placeholder
+    """
+    def __init__(self, fields: dict[str, Any], knowledge_json: Optional[str]=None,
+                       deferred: Optional[list[str]]=None, loader: Optional[FieldLoader]=None):
+        super().__init__(fields)
+        self.__json = knowledge_json
+        self.__encoded_size = (len(knowledge_json) if knowledge_json is not None else 0) + len(str(fields))
+        self.__deferred = set(deferred) if deferred is not None and loader is not None else set()
+        self.__loader = loader
+        self.__lock = threading.Lock()
+
+    @property
+    def encoded_size(self) -> int:
+    #=============================
+        """
+        The approximate size of the record when encoded as JSON, excluding any deferred fields.
+        """
+        return self.__encoded_size
+
+    def __decode_json(self):
+    #=======================
+        if self.__json is not None:
+            with self.__lock:
+                if self.__json is not None:
+                    for field, value in json.loads(self.__json).items():
+                        super().__setitem__(field, value)
+                    self.__json = None
+
+    def __json_has_field(self, field: str) -> bool:
+    #==============================================
+        # A field can only be in the JSON if its quoted name is in the encoded text,
+        # although the name may also be that of a nested field or a string value
+        if (knowledge_json := self.__json) is not None and f'"{field}"' in knowledge_json:
+            self.__decode_json()
+            return super().__contains__(field)
+        return False
+
+    def __load_field(self, field: str):
+    #==================================
+        if field in self.__deferred:
+            with self.__lock:
+                if field in self.__deferred:
+                    if super().__contains__(field):
+                        assert self.__loader is not None
+                        super().__setitem__(field, self.__loader(field, super().__getitem__(field)))
+                    self.__deferred.discard(field)
+                    if len(self.__deferred) == 0:
+                        self.__loader = None
+
+    def __materialise(self):
+    #=======================
+        self.__decode_json()
+        with self.__lock:
+            deferred = list(self.__deferred)
+        for field in deferred:
+            self.__load_field(field)
+
+    def __contains__(self, field: object) -> bool:
+    #=============================================
+        return (super().__contains__(field)
+             or (isinstance(field, str) and self.__json_has_field(field)))
+
+    def __getitem__(self, field: str) -> Any:
+    #========================================
+        if not super().__contains__(field):
+            self.__json_has_field(field)
+        self.__load_field(field)
+        return super().__getitem__(field)
+
+    def get(self, field: str, default: Any=None) -> Any:
+    #===================================================
+        if field in self:
+            return self[field]
+        return default
+
+    def __setitem__(self, field: str, value: Any):
+    #=============================================
+        self.__decode_json()
+        with self.__lock:
+            self.__deferred.discard(field)
+        super().__setitem__(field, value)
+
+    def __delitem__(self, field: str):
+    #=================================
+        self.__decode_json()
+        with self.__lock:
+            self.__deferred.discard(field)
+        super().__delitem__(field)
+
+    def __iter__(self):
+    #==================
+        self.__decode_json()
+        return super().__iter__()
+
+    def __len__(self) -> int:
+    #========================
+        self.__decode_json()
+        return super().__len__()
+
+    def __eq__(self, other: object) -> bool:
+    #=======================================
+        self.__materialise()
+        if isinstance(other, KnowledgeRecord):
+            other.__materialise()
+        return super().__eq__(other)
+
+    def __ne__(self, other: object) -> bool:
+    #=======================================
+        return not self.__eq__(other)
+
+    def __repr__(self) -> str:
+    #=========================
+        self.__materialise()
+        return super().__repr__()
+
+    def __reduce__(self):
+    #====================
+        self.__materialise()
+        return (dict, (dict(super().items()),))
+
+    def copy(self) -> dict[str, Any]:
+    #================================
+        self.__materialise()
+        return dict(super().items())
+
+    def items(self):
+    #===============
+        self.__materialise()
+        return super().items()
+
+    def keys(self):
+    #==============
+        self.__decode_json()
+        return super().keys()
+
+    def pop(self, field: str, *default: Any) -> Any:
+    #===============================================
+        if field in self:
+            value = self[field]
+            del self[field]
+            return value
+        return super().pop(field, *default)
+
+    def popitem(self) -> tuple[str, Any]:
+    #====================================
+        self.__materialise()
+        return super().popitem()
+
+    def setdefault(self, field: str, default: Any=None) -> Any:
+    #==========================================================
+        if field not in self:
+            self[field] = default
+        return self[field]
+
+    def update(self, *args, **kwds):
+    #===============================
+        for field, value in dict(*args, **kwds).items():
+            self[field] = value
+
+    def values(self):
+    #================
+        self.__materialise()
+        return super().values()
+
+    __hash__ = None     # type: ignore
+
+#===============================================================================
@@ -77,7 +77,7 @@ class SciCrunch(object):
         self.__scicrunch_release = scicrunch_release
         self.__api_endpoint = SCICRUNCH_SPARC_API.format(SCICRUNCH_RELEASE=scicrunch_release)
         self.__connectivity_query = CONNECTIVITY_QUERY if scicrunch_release == SCICRUNCH_PRODUCTION else CONNECTIVITY_QUERY_NEXT
-        self.__unknown_entities = []
+        self.__unknown_entities: set[str] = set()
         self.__scicrunch_key = scicrunch_key if scicrunch_key is not None else os.environ.get('SCICRUNCH_API_KEY')
         if self.__scicrunch_key is None:
             log.warning('Undefined SCICRUNCH_API_KEY: SciCrunch knowledge will not be looked up')
@@ -135,46 +135,54 @@ class SciCrunch(object):
                             }
         return models
 
-    def get_knowledge(self, entity: str) -> dict:
-    #============================================
+    def get_knowledge(self, entity: str) -> Optional[dict]:
+    #======================================================
+        """
+        :returns:   The entity's knowledge, an empty dictionary if SciCrunch doesn't
+                    know about the entity, or ``None`` if SciCrunch couldn't be asked,
+                    either because there is no API key or the request failed
+        """
+        if self.__scicrunch_key is None:
+            return None
         knowledge = {}
-        if self.__scicrunch_key is not None:
-            params = {
-                'api_key': self.__scicrunch_key,
-                'limit': 9999,
-            }
-            ontology = entity.split(':')[0]
-            if   ontology in INTERLEX_ONTOLOGIES:
-                data = request_json(SCICRUNCH_INTERLEX_VOCAB.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                    TERM=entity),
-                                    params=params)
-                if data is not None:
-                    knowledge['label'] = data.get('data', {}).get('label', entity)
-            elif ontology in CONNECTIVITY_ONTOLOGIES:
-                data = request_json(SCICRUNCH_CONNECTIVITY_NEURONS.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                          CONNECTIVITY_QUERY=self.__connectivity_query,
-                                                                          NEURON_ID=entity),
-                                    params=params)
-                if data is not None:
-                    knowledge = Apinatomy.neuron_knowledge(entity, data)
-            elif entity.startswith(APINATOMY_MODEL_PREFIX):
-                data = request_json(SCICRUNCH_MODEL_REFERENCES.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                      MODEL_ID=urllib.parse.quote(entity, '')),
-                                    params=params)
-                if data is not None:
-                    knowledge = Apinatomy.model_knowledge(entity, data)
-            else:
-                data = request_json(SCICRUNCH_SPARC_VOCAB.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                 TERM=entity),
-                                    params=params)
-                if data is not None:
-                    if len(labels := data.get('labels', [])):
-                        knowledge['label'] = labels[0]
-                    else:
-                        knowledge['label'] = entity
+        params = {
+            'api_key': self.__scicrunch_key,
+            'limit': 9999,
+        }
+        ontology = entity.split(':')[0]
+        if   ontology in INTERLEX_ONTOLOGIES:
+            data = request_json(SCICRUNCH_INTERLEX_VOCAB.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
+                                                                TERM=entity),
+                                params=params, not_found={})
+            if data:
+                knowledge['label'] = data.get('data', {}).get('label', entity)
+        elif ontology in CONNECTIVITY_ONTOLOGIES:
+            data = request_json(SCICRUNCH_CONNECTIVITY_NEURONS.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
+                                                                      CONNECTIVITY_QUERY=self.__connectivity_query,
+                                                                      NEURON_ID=entity),
+                                params=params, not_found={})
+            if data:
+                knowledge = Apinatomy.neuron_knowledge(entity, data)
+        elif entity.startswith(APINATOMY_MODEL_PREFIX):
+            data = request_json(SCICRUNCH_MODEL_REFERENCES.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
+                                                                  MODEL_ID=urllib.parse.quote(entity, '')),
+                                params=params, not_found={})
+            if data:
+                knowledge = Apinatomy.model_knowledge(entity, data)
+        else:
+            data = request_json(SCICRUNCH_SPARC_VOCAB.format(SCICRUNCH_RELEASE=self.__scicrunch_release,
+                                                             TERM=entity),
+                                params=params, not_found={})
+            if data:
+                if len(labels := data.get('labels', [])):
+                    knowledge['label'] = labels[0]
+                else:
+                    knowledge['label'] = entity
+        if data is None:
+            return None
         if len(knowledge) == 0 and entity not in self.__unknown_entities:
             log.warning('Unknown anatomical entity', entity=entity)
-            self.__unknown_entities.append(entity)
+            self.__unknown_entities.add(entity)
         return knowledge
 
     def connectivity_metadata(self, entity: str) -> dict[str, str|list[str]]:
@@ -183,7 +191,7 @@ class SciCrunch(object):
             return Apinatomy.get_metadata(data)
         elif entity not in self.__unknown_entities:
             log.warning('Unknown anatomical entity', entity=entity)
-            self.__unknown_entities.append(entity)
+            self.__unknown_entities.add(entity)
         return {}
 
 #===============================================================================
@@ -0,0 +1,222 @@
+#===============================================================================
+#
+#  Flatmap viewer and annotation tools
+#
+#  Copyright (c) 2019-25  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+import time
+from typing import Iterable, Iterator, Optional
+
+#===============================================================================
+
+from . import KnowledgeStore, SCHEMA_VERSION, clean_knowledge_source
+
+#===============================================================================
+
+# A snapshot file has a header, followed by JSON metadata, an index of entities,
+# and the JSON encoded knowledge of the entities. Index entries have a fixed size,
+# with each entity's UTF-8 encoding padded with NULs to the length of the longest,
+# followed by the offset and length of its knowledge, relative to the start of the
+# knowledge. Entries are sorted by entity so that entities can be found with a
+# binary search.
+
+SNAPSHOT_MAGIC = b'MAPKNOW\x00'
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_HEADER = struct.Struct('<8sIIQQI')     # magic, version, entity count, index offset,
+                                                # knowledge offset, entity width
+SNAPSHOT_ENTRY = struct.Struct('<QI')           # knowledge offset, knowledge length
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+#===============================================================================
+
+def export_snapshot(store: KnowledgeStore, snapshot_file: str|Path, source: Optional[str]=None) -> int:
+#======================================================================================================
+    """
+    Save the knowledge held for a knowledge source in a snapshot file.
+
+    The snapshot is written to a temporary file that then replaces ``snapshot_file``,
+    so that processes that have the previous snapshot open are not affected.
+
+    :param  store:          The knowledge store to export from
+    :param  snapshot_file:  The snapshot file to create
+    :param  source:         The knowledge source to export. Defaults to the store's source
+    :returns:               The number of entities saved
+    """
+    source = store.source if source is None else clean_knowledge_source(source)
+    if source is None:
+        raise ValueError('No knowledge source to export')
+    entity_knowledge: dict[bytes, bytes] = {}
+    for knowledge in store.source_knowledge(source):
+        if 'label' not in knowledge:
+            knowledge['label'] = knowledge['id']
+        entity_knowledge[knowledge['id'].encode()] = json.dumps(knowledge, separators=(',', ':')).encode()
+    entities = sorted(entity_knowledge.keys())
+    entity_width = max((len(entity) for entity in entities), default=0)
+    metadata = json.dumps({
+        'source': source,
+        'schema-version': SCHEMA_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }).encode()
+    index_offset = SNAPSHOT_HEADER.size + len(metadata)
+    knowledge_offset = index_offset + len(entities)*(entity_width + SNAPSHOT_ENTRY.size)
+
+    snapshot_file = Path(snapshot_file)
+    temp_file = snapshot_file.with_name(f'{snapshot_file.name}.{os.getpid()}.tmp')
+    try:
+        with open(temp_file, 'wb') as fp:
+            fp.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(entities),
+                                          index_offset, knowledge_offset, entity_width))
+            fp.write(metadata)
+            offset = 0
+            for entity in entities:
+                encoded = entity_knowledge[entity]
+                fp.write(entity.ljust(entity_width, b'\x00'))
+                fp.write(SNAPSHOT_ENTRY.pack(offset, len(encoded)))
+                offset += len(encoded)
+            for entity in entities:
+                fp.write(entity_knowledge[entity])
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_file, snapshot_file)
+    finally:
+        temp_file.unlink(missing_ok=True)
+    return len(entities)
+
+#===============================================================================
+
+class KnowledgeSnapshot:
+    """
+    A read-only knowledge store, for a single knowledge source, backed by a snapshot
+    created by :func:`export_snapshot`.
+
+    The snapshot is memory mapped, so processes that open the same snapshot share its
+    pages, and entities are found by a binary search of its index, without any caching.
+
+    :param  snapshot_file:  The snapshot file to open
+    """
+    def __init__(self, snapshot_file: str|Path):
+        with open(snapshot_file, 'rb') as fp:
+            try:
+                self.__mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f'Invalid knowledge snapshot: {snapshot_file}') from None
+        if len(self.__mmap) < SNAPSHOT_HEADER.size:
+            self.__mmap.close()
+            raise ValueError(f'Invalid knowledge snapshot: {snapshot_file}')
+        (magic, version, self.__count, self.__index_offset,
+         self.__knowledge_offset, self.__entity_width) = SNAPSHOT_HEADER.unpack_from(self.__mmap, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.__mmap.close()
+            raise ValueError(f'Invalid knowledge snapshot: {snapshot_file}')
+        self.__entry_size = self.__entity_width + SNAPSHOT_ENTRY.size
+        self.__metadata = json.loads(self.__mmap[SNAPSHOT_HEADER.size:self.__index_offset])
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def __contains__(self, entity: str) -> bool:
+        return self.__find(entity) is not None
+
+    @property
+    def metadata(self) -> dict[str, str]:
+        return self.__metadata
+
+    @property
+    def source(self) -> str:
+        return self.__metadata['source']
+
+    def close(self):
+    #===============
+        self.__mmap.close()
+
+    def knowledge_sources(self) -> list[str]:
+    #========================================
+        return [self.source]
+
+    def __entity(self, n: int) -> bytes:
+    #===================================
+        start = self.__index_offset + n*self.__entry_size
+        return self.__mmap[start:start + self.__entity_width].rstrip(b'\x00')
+
+    def __find(self, entity: str) -> Optional[int]:
+    #==============================================
+        key = entity.encode()
+        if len(key) > self.__entity_width:
+            return None
+        key = key.ljust(self.__entity_width, b'\x00')
+        (lo, hi) = (0, self.__count)
+        while lo < hi:
+            mid = (lo + hi)//2
+            start = self.__index_offset + mid*self.__entry_size
+            mid_key = self.__mmap[start:start + self.__entity_width]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def __knowledge(self, n: int) -> dict:
+    #=====================================
+        (offset, length) = SNAPSHOT_ENTRY.unpack_from(self.__mmap, self.__index_offset
+                                                                  + n*self.__entry_size + self.__entity_width)
+        start = self.__knowledge_offset + offset
+        return json.loads(self.__mmap[start:start + length])
+
+    def entity_knowledge(self, entity: str, source: Optional[str]=None) -> dict:
+    #===========================================================================
+        """
+        Get knowledge about an entity, as :meth:`KnowledgeStore.entity_knowledge` does
+        for a read-only store.
+        """
+        if source is not None and clean_knowledge_source(source) != self.source:
+            raise ValueError(f'Unknown knowledge source: `{source}`')
+        if (n := self.__find(entity)) is not None:
+            return self.__knowledge(n)
+        return {'source': self.source, 'label': entity}
+
+    def entity_knowledge_many(self, entities: Iterable[str], source: Optional[str]=None) -> dict[str, dict]:
+    #=======================================================================================================
+        return {entity: self.entity_knowledge(entity, source=source) for entity in dict.fromkeys(entities)}
+
+    def label(self, entity: str) -> str:
+    #===================================
+        return self.entity_knowledge(entity).get('label', entity)
+
+    def entity_type(self, entity: str) -> Optional[str]:
+    #===================================================
+        return self.entity_knowledge(entity).get('type')
+
+    def iter_entities(self) -> Iterator[str]:
+    #========================================
+        for n in range(self.__count):
+            yield self.__entity(n).decode()
+
+    def iter_stored_knowledge(self) -> Iterator[dict]:
+    #=================================================
+        for n in range(self.__count):
+            yield self.__knowledge(n)
+
+#===============================================================================
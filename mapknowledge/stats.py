@@ -0,0 +1,123 @@
+#===============================================================================
+#
+#  Flatmap viewer and annotation tools
+#
+#  Copyright (c) 2019-25  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+from typing import Iterator
+
+#===============================================================================
+
+# Lookup stages that are timed by a knowledge store
+
+STAGE_CACHE = 'cache'
+STAGE_DATABASE = 'database'
+STAGE_NPO = 'npo'
+STAGE_SCICRUNCH = 'scicrunch'
+STAGE_CONNECTIVITY_METADATA = 'connectivity-metadata'
+STAGE_WRITE = 'write'
+STAGE_COMMIT = 'commit'
+
+# Number of most recent timings of a stage used to estimate percentiles
+STATS_SAMPLES = 1024
+
+PERCENTILES = [50, 90, 99]
+
+#===============================================================================
+
+class StageTimings:
+    def __init__(self, max_samples: int):
+        self.__count = 0
+        self.__total = 0.0
+        self.__max = 0.0
+        self.__samples: deque[float] = deque(maxlen=max_samples)
+
+    def record(self, seconds: float):
+    #================================
+        self.__count += 1
+        self.__total += seconds
+        if seconds > self.__max:
+            self.__max = seconds
+        self.__samples.append(seconds)
+
+    def stats(self) -> dict[str, int|float]:
+    #=======================================
+        samples = sorted(self.__samples)
+        stats: dict[str, int|float] = {
+            'count': self.__count,
+            'total': self.__total,
+            'mean': self.__total/self.__count if self.__count else 0.0,
+            'max': self.__max,
+        }
+        for percentile in PERCENTILES:
+            stats[f'p{percentile}'] = (samples[min(len(samples) - 1, (percentile*len(samples))//100)]
+                                        if len(samples) else 0.0)
+        return stats
+
+#===============================================================================
+
+class LookupStats:
+    """
+    Counts and latencies of the stages of knowledge lookups.
+
+    Timings may be recorded by concurrent threads. Percentiles are estimated from
+    the most recent ``max_samples`` timings of each stage.
+
+    :param  max_samples:    The number of timings of a stage kept for percentiles
+    """
+    def __init__(self, max_samples: int=STATS_SAMPLES):
+        self.__max_samples = max_samples
+        self.__stages: dict[str, StageTimings] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+    #============================================
+        with self.__lock:
+            if (timings := self.__stages.get(stage)) is None:
+                timings = StageTimings(self.__max_samples)
+                self.__stages[stage] = timings
+            timings.record(seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+    #=============================================
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def reset(self):
+    #===============
+        with self.__lock:
+            self.__stages = {}
+
+    def stats(self) -> dict[str, dict[str, int|float]]:
+    #==================================================
+        """
+        :returns:   A dictionary, indexed by stage, giving the number of times the
+                    stage has been timed, along with its ``total``, ``mean``, ``max``,
+                    and ``p50``, ``p90`` and ``p99`` latencies, in seconds
+        """
+        with self.__lock:
+            return {stage: timings.stats() for stage, timings in self.__stages.items()}
+
+#===============================================================================
@@ -28,13 +28,17 @@ log = logger.bind(type='knowledge')
 #===============================================================================
 
 from json import JSONDecodeError
+from typing import Any, Optional
+
 import requests
 
 LOOKUP_TIMEOUT = 30    # seconds; for `requests.get()`
 
 #===============================================================================
 
-def request_json(endpoint, **kwds):
+def request_json(endpoint, not_found: Any=None, **kwds):
+    # ``not_found``, if given, is returned when the endpoint says that
+    # what was requested doesn't exist, as opposed to the request failing
     try:
         response = requests.get(endpoint,
                                 headers={'Accept': 'application/json'},
@@ -45,6 +49,8 @@ def request_json(endpoint, **kwds):
                 return response.json()
             except JSONDecodeError:
                 error = 'Invalid JSON returned'
+        elif response.status_code == requests.codes.not_found and not_found is not None:
+            return not_found
         else:
             error = response.reason
     except requests.exceptions.RequestException as exception:
@@ -52,4 +58,15 @@ def request_json(endpoint, **kwds):
     log.warning("Couldn't access endpoint", endpoint=endpoint, error=error)
     return None
 
+def request_content(endpoint, **kwds) -> Optional[bytes]:
+    try:
+        response = requests.get(endpoint, timeout=LOOKUP_TIMEOUT, **kwds)
+        if response.ok:
+            return response.content
+        error = response.reason
+    except requests.exceptions.RequestException as exception:
+        error = f'Exception: {exception}'
+    log.warning("Couldn't access endpoint", endpoint=endpoint, error=error)
+    return None
+
 #===============================================================================
@@ -0,0 +1,652 @@
+import argparse
+import asyncio
+import json
+from pathlib import Path
+import shutil
+import threading
+import time
+import traceback
+from typing import Callable
+import pytest
+
+import mapknowledge
+from mapknowledge import KnowledgeStore, NERVE_TYPE, PRELOAD_PATHS, SQLITE_SERVING_PROFILE
+from mapknowledge import canonical_knowledge
+from mapknowledge import NPO_LOAD_BACKGROUND, NPO_LOAD_LAZY
+from mapknowledge.async_store import AsyncKnowledgeStore
+from mapknowledge.cache import KnowledgeCache
+import mapknowledge.npo
+import mapknowledge.scicrunch
+from mapknowledge.npo import npo_release_build, NPOException
+from mapknowledge.record import KnowledgeRecord
+from mapknowledge.snapshot import export_snapshot, KnowledgeSnapshot
+from tools.sckan_connectivity import deploy_knowledge, restore, update_knowledge
+
+SCKAN_JSON = 'sckan/sckan-2024-09-21.json'
+SCKAN_SOURCE = 'sckan-2024-09-21'
+
+@pytest.fixture(scope='module')
+def store_directory(tmp_path_factory):
+    store_directory = tmp_path_factory.mktemp('store')
+    restore(argparse.Namespace(store_directory=str(store_directory),
+                               knowledge_store='knowledgebase.db',
+                               json_file=SCKAN_JSON,
+                               purge=True,
+                               commit_every=500))
+    return store_directory
+
+@pytest.fixture
+def store(store_directory):
+    store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False)
+    yield store
+    store.close()
+
+@pytest.fixture
+def writable_directory(store_directory, tmp_path):
+    shutil.copy(store_directory / 'knowledgebase.db', tmp_path / 'knowledgebase.db')
+    return tmp_path
+
+@pytest.fixture
+def writable_store(writable_directory):
+    store = KnowledgeStore(store_directory=writable_directory, use_sckan=False, verbose=False)
+    yield store
+    store.close()
+
+class SckanLookups:
+    """
+    Stands in for SCKAN, getting knowledge from ``knowledge`` and recording the
+    entities that are looked up in ``entities``.
+    """
+    def __init__(self):
+        self.entities: list[str] = []
+        self.knowledge: Callable[[str], dict] = lambda entity: {}
+
+    def lookup(self, store: KnowledgeStore, entity: str) -> dict:
+        self.entities.append(entity)
+        return {**self.knowledge(entity), 'source': store.source}
+
+@pytest.fixture
+def npo_knowledge(monkeypatch):
+    """
+    Replace NPO with a stub that knows about the entities in the returned dictionary.
+    """
+    knowledge: dict[str, dict] = {}
+    class Npo:
+        terms: list[str] = []
+        def __init__(self, npo_release, npo_build, **kwds):
+            pass
+        def get_knowledge(self, entity):
+            return dict(knowledge.get(entity, {'id': entity}))
+    monkeypatch.setattr(mapknowledge, 'Npo', Npo)
+    monkeypatch.delenv('SCICRUNCH_API_KEY', raising=False)
+    return knowledge
+
+@pytest.fixture
+def sckan_lookups(monkeypatch):
+    lookups = SckanLookups()
+    monkeypatch.setattr(KnowledgeStore, 'sckan_entity_knowledge', lambda store, entity: lookups.lookup(store, entity))
+    return lookups
+
+def test_entity_knowledge_many(store, store_directory):
+    entities = ['UBERON:0001759', 'ilxtr:neuron-type-keast-8', 'UBERON:0001759', 'XXX:unknown']
+    many_knowledge = store.entity_knowledge_many(entities)
+    assert list(many_knowledge.keys()) == entities[:2] + entities[3:]
+    store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False)
+    for entity in entities:
+        assert store.entity_knowledge(entity) == many_knowledge[entity]
+    store.close()
+    assert many_knowledge['UBERON:0001759']['label'] == 'vagus nerve'
+    assert len(many_knowledge['ilxtr:neuron-type-keast-8']['connectivity'])
+    assert many_knowledge['XXX:unknown']['label'] == 'XXX:unknown'
+
+def test_bounded_cache(store_directory):
+    store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False, cache_entries=2)
+    for entity in ['UBERON:0001759', 'ILX:0793221', 'UBERON:0001759', 'UBERON:0006448', 'ILX:0793221']:
+        store.entity_knowledge(entity)
+    stats = store.cache.stats()
+    store.close()
+    assert stats['entries'] == 2
+    assert stats['hits'] == 1
+    assert stats['misses'] == 4
+    assert stats['evictions'] == 2
+
+def test_cache_per_source():
+    cache = KnowledgeCache(max_entries=1, per_source=True)
+    cache.put(('source-1', 'A'), {'label': 'A'})
+    cache.put(('source-2', 'A'), {'label': 'A'})
+    assert cache.get(('source-1', 'A')) is not None
+    assert cache.evictions == 0
+
+def test_resave_discards_cache(writable_directory):
+    store = KnowledgeStore(store_directory=writable_directory, use_sckan=False, verbose=False, lazy_knowledge=True)
+    path = store.entity_knowledge('ilxtr:neuron-type-keast-8')
+    assert len(path['connectivity'])
+    store.store_entity_knowledge('ilxtr:neuron-type-keast-8', {'label': 'a re-saved path',
+                                                               'connectivity': [[['XXX:1', []], ['XXX:2', []]]]})
+    knowledge = store.entity_knowledge('ilxtr:neuron-type-keast-8')
+    assert knowledge['label'] == 'a re-saved path'
+    assert knowledge['connectivity'] == [[['XXX:1', []], ['XXX:2', []]]]
+    store.close()
+
+def test_threaded_store(store, store_directory):
+    from concurrent.futures import ThreadPoolExecutor
+    expected_labels = store.labels()[:200]
+    threaded_store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False, threaded=True)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        labels = list(executor.map(threaded_store.label, [entity for (entity, _) in expected_labels]))
+    threaded_store.close()
+    assert labels == [label for (_, label) in expected_labels]
+
+def test_threaded_store_is_read_only(store_directory):
+    with pytest.raises(ValueError):
+        KnowledgeStore(store_directory=store_directory, threaded=True, use_sckan=False)
+
+def test_serving_profile(store_directory):
+    store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False,
+                           profile=SQLITE_SERVING_PROFILE)
+    assert store.db is not None
+    assert store.db.execute('pragma mmap_size').fetchone()[0] > 0
+    assert store.db.execute('pragma journal_mode').fetchone()[0] == 'delete'
+    assert store.entity_knowledge('UBERON:0001759')['label'] == 'vagus nerve'
+    store.close()
+
+def test_source_knowledge_round_trip(store):
+    with open(SCKAN_JSON) as fp:
+        saved_knowledge = {knowledge['id']: knowledge for knowledge in json.load(fp)['knowledge']}
+    source_knowledge = json.loads(json.dumps(store.source_knowledge(SCKAN_SOURCE)))
+    assert len(source_knowledge) == len(saved_knowledge)
+    for knowledge in source_knowledge:
+        assert knowledge == json.loads(json.dumps(canonical_knowledge(saved_knowledge[knowledge['id']])))
+
+def test_label_and_type(store):
+    assert store.label('ilxtr:neuron-type-keast-8') == 'neuron type kblad 8'
+    assert store.entity_type('ILX:0793221') == NERVE_TYPE
+    assert store.entity_type('UBERON:0006448') is None
+
+def test_lazy_knowledge(store, store_directory):
+    entities = ['UBERON:0001759', 'ilxtr:neuron-type-keast-8', 'ilxtr:sparc-nlp/kidney/140']
+    lazy_store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False, lazy_knowledge=True)
+    knowledge = lazy_store.entity_knowledge('ilxtr:neuron-type-keast-8')
+    assert isinstance(knowledge, KnowledgeRecord)
+    assert knowledge['label'] == 'neuron type kblad 8'
+    assert dict.get(knowledge, 'connectivity') is None
+    assert len(knowledge['connectivity']) == len(store.entity_knowledge('ilxtr:neuron-type-keast-8')['connectivity'])
+    for entity in entities:
+        lazy_knowledge = lazy_store.entity_knowledge(entity)
+        assert lazy_knowledge == store.entity_knowledge(entity)
+        assert json.loads(json.dumps(lazy_knowledge)) == json.loads(json.dumps(store.entity_knowledge(entity)))
+    lazy_store.close()
+
+def test_record_field_named_in_values():
+    record = KnowledgeRecord({'id': 'A'}, json.dumps({'references': ['phenotypes'],
+                                                      'paths': [{'id': 'B', 'models': 'C'}]}))
+    assert record.get('phenotypes', 'default') == 'default'
+    assert 'phenotypes' not in record
+    assert 'phenotypes' not in record
+    assert record.get('models') is None
+    with pytest.raises(KeyError):
+        record['models']
+    assert record['references'] == ['phenotypes']
+
+def test_threaded_lazy_record():
+    from concurrent.futures import ThreadPoolExecutor
+    edges = [[['XXX:1', []], ['XXX:2', []]]]
+    def loader(field, placeholder):
+        time.sleep(0.1)
+        return edges
+    record = KnowledgeRecord({'id': 'A'}, json.dumps({'connectivity': []}), deferred=['connectivity'], loader=loader)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: record['connectivity'], range(4)))
+    assert results == 4*[edges]
+
+def test_threaded_lazy_store(store, store_directory):
+    from concurrent.futures import ThreadPoolExecutor
+    entities = ['ilxtr:neuron-type-keast-8', 'ilxtr:sparc-nlp/kidney/140']
+    lazy_store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False,
+                                threaded=True, lazy_knowledge=True)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        connectivity = list(executor.map(lambda entity: lazy_store.entity_knowledge(entity)['connectivity'],
+                                         8*entities))
+    lazy_store.close()
+    assert connectivity == 8*[store.entity_knowledge(entity)['connectivity'] for entity in entities]
+
+def test_iter_stored_knowledge(store):
+    stored_knowledge = store.stored_knowledge()
+    assert list(store.iter_stored_knowledge(chunk_size=7)) == stored_knowledge
+    assert list(store.iter_labels()) == [(knowledge['id'], knowledge['label']) for knowledge in stored_knowledge]
+
+def test_clean_connectivity(writable_store):
+    store = writable_store
+    connectivity_terms = set()
+    for (node, ) in store.db.execute('select n.node from connectivity_nodes c join nodes n on n.id = c.node').fetchall():
+        node = json.loads(node)
+        connectivity_terms.update([node[0]] + node[1])
+    entities = set(entity for (entity, _) in store.labels(SCKAN_SOURCE))
+    store.clean_connectivity(SCKAN_SOURCE)
+    remaining = set(entity for (entity, _) in store.labels(SCKAN_SOURCE))
+    assert remaining == set(entity for entity in entities.difference(connectivity_terms)
+                                if not entity.startswith('ilxtr:'))
+    assert store.db.execute('select count(*) from connectivity_nodes').fetchone()[0] == 0
+    assert store.db.execute('select count(*) from path_edges').fetchone()[0] == 0
+    assert store.db.execute('select count(*) from nodes').fetchone()[0] == 0
+
+def test_bulk_load(store, tmp_path):
+    knowledge = store.source_knowledge(SCKAN_SOURCE)[:25]
+    bulk_store = KnowledgeStore(store_directory=tmp_path, use_sckan=False, verbose=False)
+    progress = None
+    with pytest.raises(RuntimeError):
+        with bulk_store.bulk_load(commit_every=10) as progress:
+            for entity_knowledge in knowledge:
+                bulk_store.store_entity_knowledge(entity_knowledge['id'], entity_knowledge, source=SCKAN_SOURCE)
+            raise RuntimeError('Load failed')
+    assert progress is not None
+    assert progress.committed == 20
+    assert progress.last_committed == knowledge[19]['id']
+    assert len(bulk_store.labels(SCKAN_SOURCE)) == 20
+    with bulk_store.bulk_load(commit_every=10) as progress:
+        for entity_knowledge in knowledge:
+            bulk_store.store_entity_knowledge(entity_knowledge['id'], entity_knowledge, source=SCKAN_SOURCE)
+    assert progress.committed == 25
+    bulk_store.close()
+    bulk_store = KnowledgeStore(store_directory=tmp_path, read_only=True, verbose=False)
+    assert bulk_store.source_knowledge(SCKAN_SOURCE) == knowledge
+    bulk_store.close()
+
+def test_paths_through(store):
+    paths = {'region': set(), 'layer': set()}
+    for knowledge in store.source_knowledge(SCKAN_SOURCE):
+        for edge in knowledge.get('connectivity', []):
+            for node in edge:
+                if node[0] == 'UBERON:0001759':
+                    paths['region'].add(knowledge['id'])
+                if 'UBERON:0001759' in node[1]:
+                    paths['layer'].add(knowledge['id'])
+    assert len(paths['region'] | paths['layer'])
+    assert store.paths_through('UBERON:0001759') == sorted(paths['region'] | paths['layer'])
+    assert store.paths_through('UBERON:0001759', as_layer=False) == sorted(paths['region'])
+    assert store.paths_through('UBERON:0001759', as_layer=True) == sorted(paths['layer'])
+    assert store.paths_through('UBERON:0001759', source='unknown-source') == []
+
+def test_search_labels(store, writable_store):
+    matches = store.search_labels('vag ner')
+    assert matches[0] == ('UBERON:0001759', 'vagus nerve')
+    assert all('vag' in label.lower() or 'vag' in (store.entity_knowledge(entity).get('long-label') or '').lower()
+                    for entity, label in matches)
+    assert len(store.search_labels('vag', limit=3)) == 3
+    assert store.search_labels('"') == []
+    assert store.search_labels('') == []
+    store = writable_store
+    store.store_entity_knowledge('UBERON:0001759', {'label': 'wandering nerve'}, source=SCKAN_SOURCE)
+    store.db.commit()
+    assert 'UBERON:0001759' not in [entity for (entity, _) in store.search_labels('vagus nerve', limit=100)]
+    assert store.search_labels('wander') == [('UBERON:0001759', 'wandering nerve')]
+    # Only label changes update the index
+    changes = store.db.total_changes
+    store.db.execute('update knowledge set verified=? where entity=?', (time.time(), 'UBERON:0001759'))
+    assert store.db.total_changes - changes == 1
+    store.db.execute('update knowledge set label=? where entity=?', ('roaming nerve', 'UBERON:0001759'))
+    assert store.search_labels('roam') == [('UBERON:0001759', 'roaming nerve')]
+    assert store.search_labels('wander') == []
+    store.purge_knowledge(SCKAN_SOURCE)
+    store.db.commit()
+    assert store.search_labels('wander') == []
+
+def test_unknown_entities(writable_directory, writable_store, sckan_lookups):
+    assert writable_store.entity_knowledge('XXX:unknown')['label'] == 'XXX:unknown'
+    writable_store.close()
+    store = KnowledgeStore(store_directory=writable_directory, use_sckan=False, verbose=False)
+    assert store.entity_knowledge('XXX:unknown')['label'] == 'XXX:unknown'
+    assert sckan_lookups.entities == ['XXX:unknown']
+    store.close()
+    store = KnowledgeStore(store_directory=writable_directory, use_sckan=False, verbose=False, unknown_entity_ttl=0)
+    store.entity_knowledge('XXX:unknown')
+    assert sckan_lookups.entities == ['XXX:unknown', 'XXX:unknown']
+    store.purge_knowledge(SCKAN_SOURCE)
+    assert store.db is not None
+    assert store.db.execute('select count(*) from unknown_entities').fetchone()[0] == 0
+    store.close()
+
+def test_unanswered_lookups(writable_directory, npo_knowledge, monkeypatch):
+    def unknown_entities(**kwds):
+        store = KnowledgeStore(store_directory=writable_directory, sckan_version=SCKAN_SOURCE, verbose=False, **kwds)
+        store.entity_knowledge('XXX:unknown')
+        store.entity_knowledge('ilxtr:unknown')     # NPO knows all connectivity
+        assert store.db is not None
+        entities = [row[0] for row in store.db.execute('select entity from unknown_entities order by entity')]
+        store.purge_knowledge(SCKAN_SOURCE)
+        store.close()
+        return entities
+    assert unknown_entities() == ['ilxtr:unknown']      # No SciCrunch key
+    monkeypatch.setattr(mapknowledge.scicrunch, 'request_json', lambda endpoint, not_found=None, **kwds: None)
+    assert unknown_entities(scicrunch_key='key') == ['ilxtr:unknown']
+    monkeypatch.setattr(mapknowledge.scicrunch, 'request_json', lambda endpoint, not_found=None, **kwds: not_found)
+    assert unknown_entities(scicrunch_key='key') == ['XXX:unknown', 'ilxtr:unknown']
+
+def test_unanswered_verification(writable_directory, writable_store, npo_knowledge, monkeypatch):
+    writable_store.store_entity_knowledge('XXX:unlabelled', {'label': 'XXX:unlabelled'}, source=SCKAN_SOURCE)
+    writable_store.db.commit()
+    writable_store.close()
+    def verified(**kwds):
+        store = KnowledgeStore(store_directory=writable_directory, sckan_version=SCKAN_SOURCE, verbose=False,
+                               refresh_after=0, **kwds)
+        store.entity_knowledge('XXX:unlabelled')
+        assert store.db is not None
+        verified = store.db.execute('select verified from knowledge where source=? and entity=?',
+                                    (SCKAN_SOURCE, 'XXX:unlabelled')).fetchone()[0]
+        store.close()
+        return verified
+    assert verified() is None      # No SciCrunch key
+    monkeypatch.setattr(mapknowledge.scicrunch, 'request_json', lambda endpoint, not_found=None, **kwds: None)
+    assert verified(scicrunch_key='key') is None
+    monkeypatch.setattr(mapknowledge.scicrunch, 'request_json', lambda endpoint, not_found=None, **kwds: not_found)
+    assert verified(scicrunch_key='key') is not None
+
+def test_verified_knowledge(writable_directory, writable_store, sckan_lookups, npo_knowledge):
+    sckan_lookups.knowledge = lambda entity: {'id': entity, 'label': entity}
+    lookups = sckan_lookups.entities
+    def knowledge_store(**kwds):
+        return KnowledgeStore(store_directory=writable_directory, use_sckan=False, verbose=False, **kwds)
+    store = writable_store
+    store.store_entity_knowledge('XXX:unlabelled', {'label': 'XXX:unlabelled'}, source=SCKAN_SOURCE)
+    store.db.commit()
+    store.entity_knowledge('XXX:unlabelled')
+    store.close()
+    assert lookups == ['XXX:unlabelled']
+    store = knowledge_store()
+    store.entity_knowledge('XXX:unlabelled')
+    store.entity_knowledge('UBERON:0001759', refresh=True)      # Ignored without a SCKAN connection
+    store.close()
+    store = KnowledgeStore(store_directory=writable_directory, sckan_version=SCKAN_SOURCE, verbose=False)
+    store.entity_knowledge('UBERON:0001759', refresh=True)
+    store.close()
+    assert lookups == ['XXX:unlabelled', 'UBERON:0001759']
+    store = knowledge_store(refresh_after=0)
+    store.entity_knowledge('XXX:unlabelled')
+    store.close()
+    assert lookups == ['XXX:unlabelled', 'UBERON:0001759', 'XXX:unlabelled']
+
+def test_connectivity_terms(writable_store, sckan_lookups):
+    path_knowledge = {
+        'ilxtr:neuron-type-test': {'label': 'a path', 'connectivity': [
+                [['XXX:1', []], ['XXX:2', ['XXX:3']]],
+                [['XXX:2', ['XXX:3']], ['XXX:1', []]]
+            ]},
+        'XXX:3': {'label': 'a path term', 'connectivity': [[['XXX:4', ['XXX:1']], ['XXX:2', []]]]}
+    }
+    stack_depths = []
+    def sckan_knowledge(entity):
+        stack_depths.append(len(traceback.extract_stack()))
+        return path_knowledge.get(entity, {'label': f'{entity} label'})
+    sckan_lookups.knowledge = sckan_knowledge
+    writable_store.entity_knowledge('ilxtr:neuron-type-test')
+    assert sckan_lookups.entities == ['ilxtr:neuron-type-test', 'XXX:1', 'XXX:2', 'XXX:3', 'XXX:4']
+    assert len(set(stack_depths)) == 1
+    assert writable_store.stats()['commit']['count'] == 1
+    assert writable_store.label('XXX:4') == 'XXX:4 label'
+    assert sckan_lookups.entities == ['ilxtr:neuron-type-test', 'XXX:1', 'XXX:2', 'XXX:3', 'XXX:4']
+
+def test_preload(store_directory):
+    store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False)
+    entities = [entity for (entity, _) in store.labels()]
+    assert store.preload(kinds=[PRELOAD_PATHS]) == len(store.cache) > 0
+    assert all('connectivity' in knowledge
+                for entity in entities if (knowledge := store.cache.get((SCKAN_SOURCE, entity))) is not None)
+    assert store.preload() == len(entities) == len(store.cache)
+    misses = store.cache.misses
+    knowledge = store.entity_knowledge_many(entities)
+    assert store.cache.misses == misses
+    store.close()
+    store = KnowledgeStore(store_directory=store_directory, read_only=True, verbose=False)
+    assert knowledge == store.entity_knowledge_many(entities)
+    with pytest.raises(ValueError):
+        store.preload(kinds=['models'])
+    store.close()
+
+def test_shared_payloads(writable_store):
+    store = writable_store
+    payload_count = store.db.execute('select count(*) from knowledge_payloads').fetchone()[0]
+    store.store_entity_knowledge('XXX:stale', {'label': 'stale knowledge'}, source='sckan-next')
+    store.copy_knowledge(SCKAN_SOURCE, 'sckan-next')
+    store.db.commit()
+    assert store.db.execute('select count(*) from knowledge_payloads').fetchone()[0] == payload_count
+    assert 'XXX:stale' not in [knowledge['id'] for knowledge in store.source_knowledge('sckan-next')]
+    next_knowledge = store.source_knowledge('sckan-next')
+    assert [{**knowledge, 'source': SCKAN_SOURCE} for knowledge in next_knowledge] == store.source_knowledge(SCKAN_SOURCE)
+    assert store.paths_through('UBERON:0001759', source='sckan-next') == store.paths_through('UBERON:0001759')
+    store.store_entity_knowledge('UBERON:0001759', {'label': 'vagus nerve', 'synonyms': ['CN X']}, source='sckan-next')
+    assert store.db.execute('select count(*) from knowledge_payloads').fetchone()[0] == payload_count + 1
+    store.purge_knowledge(SCKAN_SOURCE)
+    store.db.commit()
+    assert ([knowledge for knowledge in store.source_knowledge('sckan-next') if knowledge['id'] != 'UBERON:0001759']
+         == [knowledge for knowledge in next_knowledge if knowledge['id'] != 'UBERON:0001759'])
+    store.purge_knowledge('sckan-next')
+    store.db.commit()
+    for table in ['knowledge_payloads', 'path_edges', 'path_nodes']:
+        assert store.db.execute(f'select count(*) from {table}').fetchone()[0] == 0
+
+def test_canonical_payloads(writable_store):
+    store = writable_store
+    path = next(knowledge for knowledge in store.source_knowledge(SCKAN_SOURCE)
+                    if len(knowledge.get('connectivity', [])) > 1 and len(knowledge.get('axons', [])) > 1)
+    payload_count = store.db.execute('select count(*) from knowledge_payloads').fetchone()[0]
+    shuffled = {field: list(reversed(value)) if field in ['connectivity', 'axons', 'dendrites', 'nerves'] else value
+                    for field, value in path.items()}
+    assert shuffled != path
+    store.store_entity_knowledge(path['id'], shuffled, source='sckan-next')
+    store.db.commit()
+    assert store.db.execute('select count(*) from knowledge_payloads').fetchone()[0] == payload_count
+    assert store.entity_knowledge(path['id'], source='sckan-next') == {**path, 'source': 'sckan-next'}
+
+def test_update_knowledge(writable_directory, sckan_lookups, npo_knowledge):
+    store = KnowledgeStore(store_directory=writable_directory, sckan_version='sckan-next', verbose=False)
+    previous_knowledge = {knowledge['id']: knowledge for knowledge in store.source_knowledge(SCKAN_SOURCE)}
+    paths = [entity for entity, knowledge in previous_knowledge.items() if 'connectivity' in knowledge]
+    npo_knowledge.update({entity: {field: value for field, value in knowledge.items() if field != 'source'}
+                            for entity, knowledge in previous_knowledge.items() if entity != paths[0]})
+    changed_connectivity = [previous_knowledge[paths[-1]]['connectivity'][0]]
+    npo_knowledge[paths[1]] = {**npo_knowledge[paths[1]], 'label': 'a changed path',
+                               'connectivity': changed_connectivity}
+    npo_knowledge['ilxtr:neuron-type-new'] = {'id': 'ilxtr:neuron-type-new', 'label': 'a new path'}
+    # NPO gives edges and nodes in an arbitrary order
+    permuted = next(entity for entity in paths[2:] if len(npo_knowledge[entity]['connectivity']) > 1)
+    npo_knowledge[permuted] = {field: list(reversed(value)) if field in ['connectivity', 'axons', 'dendrites'] else value
+                                    for field, value in npo_knowledge[permuted].items()}
+    assert npo_knowledge[permuted]['connectivity'] != previous_knowledge[permuted]['connectivity']
+    sckan_lookups.knowledge = lambda entity: npo_knowledge[entity]
+    summary = update_knowledge(store, 'sckan-next', SCKAN_SOURCE, list(npo_knowledge.keys()), 100)
+    assert summary == {'added': 1, 'changed': 1, 'removed': 1, 'unchanged': len(npo_knowledge) - 2}
+    assert sckan_lookups.entities == [paths[1], 'ilxtr:neuron-type-new']
+    assert store.label(paths[1]) == 'a changed path'
+    changed_nodes = set(json.dumps(node, separators=(',', ':')) for edge in changed_connectivity for node in edge)
+    assert store.db is not None
+    assert (set(row[0] for row in store.db.execute('''select n.node from connectivity_nodes c join nodes n on n.id = c.node
+                                                        where c.source=? and c.path=?''', ('sckan-next', paths[1])))
+         == changed_nodes)
+    assert paths[0] not in [entity for (entity, _) in store.labels('sckan-next')]
+    store.close()
+
+def test_async_knowledge_store(writable_store, sckan_lookups):
+    in_flight = {'now': 0, 'peak': 0}
+    lock = threading.Lock()
+    def sckan_knowledge(entity):
+        with lock:
+            in_flight['now'] += 1
+            in_flight['peak'] = max(in_flight['peak'], in_flight['now'])
+        time.sleep(0.2)
+        with lock:
+            in_flight['now'] -= 1
+        return {'id': entity, 'label': f'{entity} label'}
+    sckan_lookups.knowledge = sckan_knowledge
+    store = writable_store
+    async_store = AsyncKnowledgeStore(store, max_concurrency=4)
+    entities = [f'XXX:{n}' for n in range(8)]
+    async def get_knowledge():
+        return await asyncio.gather(async_store.entity_knowledge_many(entities + ['UBERON:0001759']),
+                                    async_store.entity_knowledge('XXX:0'))
+    (many_knowledge, knowledge) = asyncio.run(get_knowledge())
+    assert 1 < in_flight['peak'] <= 4
+    assert sorted(sckan_lookups.entities) == entities
+    assert many_knowledge['XXX:0'] == knowledge
+    assert many_knowledge['XXX:7']['label'] == 'XXX:7 label'
+    assert many_knowledge['UBERON:0001759']['label'] == 'vagus nerve'
+    assert store.label('XXX:3') == 'XXX:3 label'
+    async_store.close()
+
+def test_async_lookup_error(writable_store, sckan_lookups):
+    def sckan_knowledge(entity):
+        if entity == 'XXX:2':
+            raise RuntimeError('Cannot load NPO')
+        if entity == 'XXX:1':
+            return {'id': entity, 'label': f'{entity} label', 'connectivity': [[['XXX:2', []], ['XXX:3', []]]]}
+        return {'id': entity, 'label': f'{entity} label'}
+    sckan_lookups.knowledge = sckan_knowledge
+    async_store = AsyncKnowledgeStore(writable_store)
+    with pytest.raises(RuntimeError):
+        asyncio.run(async_store.entity_knowledge('XXX:1'))
+    assert sckan_lookups.entities == ['XXX:1', 'XXX:2', 'XXX:3']
+    # The next request doesn't commit knowledge saved by the failed one
+    assert asyncio.run(async_store.entity_knowledge('XXX:4'))['label'] == 'XXX:4 label'
+    for (entity, count) in [('XXX:1', 0), ('XXX:3', 0), ('XXX:4', 1)]:
+        assert writable_store.db.execute('select count(*) from knowledge where entity=?', (entity,)).fetchone()[0] == count
+    async_store.close()
+
+def test_lookup_stats(writable_store):
+    store = writable_store
+    store.entity_knowledge_many(['UBERON:0001759', 'UBERON:0000948'])
+    store.entity_knowledge('UBERON:0001759')
+    store.store_entity_knowledge('XXX:1', {'id': 'XXX:1', 'label': 'XXX:1 label'})
+    stats = store.stats(reset=True)
+    assert stats['cache']['count'] == 3
+    assert stats['database']['count'] == 1
+    assert stats['write']['count'] == 1
+    assert 0 <= stats['database']['p50'] <= stats['database']['max'] <= stats['database']['total']
+    assert 'npo' not in stats
+    assert store.stats() == {}
+
+def test_lazy_npo(writable_directory, monkeypatch):
+    loads = []
+    class Npo:
+        def __init__(self, npo_release, npo_build, **kwds):
+            loads.append(npo_release)
+        terms = ['UBERON:0001759']
+        def get_knowledge(self, entity):
+            return {'id': entity, 'label': f'{entity} label'}
+    monkeypatch.setattr(mapknowledge, 'Npo', Npo)
+    store = KnowledgeStore(store_directory=writable_directory, sckan_version=SCKAN_SOURCE, verbose=False,
+                           npo_loading=NPO_LOAD_LAZY)
+    assert store.source == SCKAN_SOURCE
+    assert store.label('UBERON:0001759') == 'vagus nerve'
+    assert loads == []
+    assert store.label('XXX:1') == 'XXX:1 label'
+    assert store.entities() == ['UBERON:0001759']
+    assert loads == [SCKAN_SOURCE]
+    store.close()
+    store = KnowledgeStore(store_directory=writable_directory, sckan_version=SCKAN_SOURCE, verbose=False,
+                           npo_loading=NPO_LOAD_BACKGROUND)
+    assert store.entities() == ['UBERON:0001759']
+    assert loads == [SCKAN_SOURCE, SCKAN_SOURCE]
+    store.close()
+
+def test_snapshot(store, tmp_path):
+    snapshot_file = tmp_path / f'{SCKAN_SOURCE}.snapshot'
+    assert export_snapshot(store, snapshot_file) == len(store.source_knowledge(SCKAN_SOURCE))
+    snapshot = KnowledgeSnapshot(snapshot_file)
+    assert snapshot.source == SCKAN_SOURCE
+    entities = list(snapshot.iter_entities())
+    assert entities == sorted(entities, key=lambda entity: entity.encode())
+    for entity in entities[:50] + entities[-50:]:
+        assert snapshot.entity_knowledge(entity) == store.entity_knowledge(entity)
+    assert snapshot.label('UBERON:0001759') == 'vagus nerve'
+    assert 'XXX:unknown' not in snapshot
+    assert snapshot.entity_knowledge('XXX:unknown') == store.entity_knowledge('XXX:unknown')
+    snapshot.close()
+    (tmp_path / 'invalid.snapshot').write_bytes(b'not a snapshot')
+    with pytest.raises(ValueError):
+        KnowledgeSnapshot(tmp_path / 'invalid.snapshot')
+
+def test_deploy_knowledge(writable_store, tmp_path):
+    store = writable_store
+    store.copy_knowledge(SCKAN_SOURCE, 'sckan-next')
+    store.store_entity_knowledge('XXX:next', {'id': 'XXX:next', 'label': 'next only'}, source='sckan-next')
+    store.db.commit()
+    count = len(store.source_knowledge(SCKAN_SOURCE))
+    deploy_file = tmp_path / 'deploy' / f'{SCKAN_SOURCE}.db'
+    deploy_file.parent.mkdir()
+    assert deploy_knowledge(store, SCKAN_SOURCE, deploy_file) == count
+    deployed = KnowledgeStore(store_directory=deploy_file.parent, knowledge_base=deploy_file.name,
+                              read_only=True, use_sckan=False, verbose=False)
+    assert deployed.knowledge_sources() == [SCKAN_SOURCE]
+    assert deployed.metadata('deployed-source') == SCKAN_SOURCE
+    assert deployed.metadata('deployed-entities') == str(count)
+    assert deployed.label('UBERON:0001759') == 'vagus nerve'
+    assert deployed.search_labels('vagus nerve')[0][0] == 'UBERON:0001759'
+    assert deployed.db is not None
+    assert deployed.db.execute('select count(*) from sqlite_stat1').fetchone()[0] > 0
+    assert deployed.db.execute('select count(*) from knowledge where source=?', ('sckan-next',)).fetchone()[0] == 0
+    deployed.close()
+
+def test_cached_npo_build(tmp_path, monkeypatch):
+    with pytest.raises(NPOException):
+        npo_release_build(SCKAN_SOURCE, cache_directory=tmp_path, offline=True)
+    build = {'sha': '0123abcd', 'released': '2024-09-21', 'release': SCKAN_SOURCE, 'path': SCKAN_SOURCE}
+    (tmp_path / SCKAN_SOURCE).mkdir()
+    (tmp_path / SCKAN_SOURCE / 'build.json').write_text(json.dumps(build))
+    assert npo_release_build(SCKAN_SOURCE, cache_directory=tmp_path, offline=True) == build
+    assert npo_release_build(None, cache_directory=tmp_path, offline=True) == build
+    # The cached build is used when GitHub isn't available
+    monkeypatch.setattr(mapknowledge.npo, 'request_json', lambda endpoint, **kwds: None)
+    assert npo_release_build(SCKAN_SOURCE, cache_directory=tmp_path) == build
+    with pytest.raises(NPOException):
+        npo_release_build('sckan-2000-01-01', cache_directory=tmp_path)
+
+NPO_TTL_FILES = ['ttl/generated/neurons/apinat-partial-orders.ttl', 'ttl/generated/neurons/apinat-pops-more.ttl',
+                 'ttl/generated/neurons/apinat-simple-sheet.ttl', 'ttl/generated/neurons/sparc-nlp.ttl',
+                 'ttl/generated/neurons/apinat-complex.ttl', 'ttl/generated/neurons/apinatomy-neuron-populations.ttl',
+                 'ttl/npo.ttl', 'ttl/sparc-community-terms.ttl', 'ttl/generated/part-of-self.ttl',
+                 'ttl/phenotype-core.ttl', 'ttl/phenotypes.ttl', 'ttl/phenotype-indicators.ttl']
+
+def write_npo_ttls(directory):
+    for ttl_file in NPO_TTL_FILES:
+        path = directory / ttl_file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"""@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix owl: <http://www.w3.org/2002/07/owl#> .
+<http://example.org/{path.stem}> a owl:Ontology .
+<http://purl.obolibrary.org/obo/UBERON_0001759> rdfs:label "vagus nerve" .
+""")
+
+def test_offline_npo(tmp_path, monkeypatch):
+    build = {'sha': '0123abcd', 'released': '2024-09-21', 'release': SCKAN_SOURCE, 'path': SCKAN_SOURCE}
+    (tmp_path / SCKAN_SOURCE).mkdir()
+    (tmp_path / SCKAN_SOURCE / 'build.json').write_text(json.dumps(build))
+    write_npo_ttls(tmp_path / SCKAN_SOURCE / build['sha'])
+    def request_content(endpoint, **kwds):
+        raise AssertionError(f'Offline NPO accessed {endpoint}')
+    monkeypatch.setattr(mapknowledge.npo, 'request_content', request_content)
+    npo = mapknowledge.npo.Npo(SCKAN_SOURCE, cache_directory=tmp_path, offline=True)
+    assert npo.release == SCKAN_SOURCE
+    assert npo.terms == ['UBERON:0001759']
+
+def test_local_npo(tmp_path, monkeypatch):
+    def request_content(endpoint, **kwds):
+        raise AssertionError(f'Local NPO accessed {endpoint}')
+    monkeypatch.setattr(mapknowledge.npo, 'request_content', request_content)
+    checkout = tmp_path / 'NIF-Ontology'
+    write_npo_ttls(checkout)
+    (checkout / '.git' / 'refs' / 'tags').mkdir(parents=True)
+    (checkout / '.git' / 'HEAD').write_text(f'ref: refs/tags/{SCKAN_SOURCE}\n')
+    (checkout / '.git' / 'refs' / 'tags' / SCKAN_SOURCE).write_text('0123abcd\n')
+    npo = mapknowledge.npo.Npo(SCKAN_SOURCE, cache_directory=None, npo_path=checkout)
+    assert npo.release == SCKAN_SOURCE
+    assert npo.build()['sha'] == '0123abcd'
+    assert npo.terms == ['UBERON:0001759']
+    flat = tmp_path / 'flat'
+    flat.mkdir()
+    for ttl_file in NPO_TTL_FILES:
+        (checkout / ttl_file).rename(flat / Path(ttl_file).name)
+    npo = mapknowledge.npo.Npo(None, cache_directory=None, offline=True, npo_path=flat)
+    assert npo.release == 'flat'
+    assert npo.build()['sha'] is None
+    assert npo.terms == ['UBERON:0001759']
+    with pytest.raises(NPOException):
+        mapknowledge.npo.Npo(None, npo_path=tmp_path / 'missing')
@@ -1,7 +1,9 @@
+import os
 import pytest
 from mapknowledge import KnowledgeStore, NERVE_TYPE
 
-store = KnowledgeStore(sckan_version='sckan-2024-09-21')
+# Set ``NPO_PATH`` to a NIF-Ontology checkout of the release to test without network access
+store = KnowledgeStore(sckan_version='sckan-2024-09-21', npo_path=os.environ.get('NPO_PATH'))
 
 def test_path_contains_expected_nerves():
     knowledge = store.entity_knowledge('ilxtr:neuron-type-keast-8')
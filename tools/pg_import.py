@@ -70,10 +70,7 @@ def store_knowledge(args) -> KnowledgeList:
     if store.source is None:
         raise ValueError(f'No valid knowledge sources in {args.store_directory}/{args.knowledge_store}')
     knowledge = KnowledgeList(KnowledgeSource(source_id=store.source, sckan_id=store.source))
-    for row in store.db.execute('select entity, knowledge from knowledge where source=?', (store.source,)).fetchall():
-        entity_knowledge = json.loads(row[1])
-        entity_knowledge['id'] = row[0]
-        knowledge.knowledge.append(entity_knowledge)
+    knowledge.knowledge.extend(store.source_knowledge(store.source))
     store.close()
     return knowledge
 
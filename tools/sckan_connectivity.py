@@ -22,47 +22,100 @@ import json
 import logging
 import os
 from pathlib import Path
+import time
 from typing import Optional
 
 from tqdm import tqdm
 
 #===============================================================================
 
-from mapknowledge import KnowledgeStore
+from mapknowledge import KnowledgeStore, BULK_LOAD_COMMIT_EVERY, SQLITE_BULK_LOAD_PROFILE
+from mapknowledge import canonical_knowledge
+from mapknowledge.snapshot import export_snapshot, SNAPSHOT_SUFFIX
 
 #===============================================================================
 
-def get_prior_knowledge(store: KnowledgeStore, knowledge_source: Optional[str]) -> list[tuple[str, str]]:
-#========================================================================================================
+def get_prior_knowledge(store: KnowledgeStore, knowledge_source: Optional[str]) -> list[dict]:
+#=============================================================================================
     if store.db is not None and knowledge_source is not None:
         sources = store.knowledge_sources()     # Ordered, most recent first
         if len(sources) and knowledge_source not in sources:
             # We have no knowledge of the new source so first copy all knowledge from
-            # the previous source, updating the source column for the new source
-            prior_knowledge = store.db.execute('select entity, knowledge from knowledge where source=?',
-                                (sources[0], )).fetchall()
-            store.db.executemany('insert into knowledge (source, entity, knowledge) values (?, ?, ?)',
-                                ((knowledge_source, row[0], row[1]) for row in prior_knowledge))
+            # the previous source. Knowledge payloads are shared so only rows are copied
+            store.copy_knowledge(sources[0], knowledge_source)
             store.db.commit()
         # Now remove all connectivity knowledge
         store.clean_connectivity(knowledge_source)
         # Get all non-connectivity knowledge
-        prior_knowledge = store.db.execute('select entity, knowledge from knowledge where source=?',
-                                            (knowledge_source, )).fetchall()
+        prior_knowledge = store.source_knowledge(knowledge_source)
         # Delete everything to do with the new knowledge source
-        store.db.execute('delete from knowledge where source=?', (knowledge_source,))
+        store.purge_knowledge(knowledge_source)
         store.db.commit()
         # Return the non-connectivity knowledge from the previous source
         return prior_knowledge
     return []
 
-def save_prior_knowledge(store: KnowledgeStore, knowledge_source: Optional[str], prior_knowledge: list[tuple[str, str]]):
-#========================================================================================================================
+def save_prior_knowledge(store: KnowledgeStore, knowledge_source: Optional[str], prior_knowledge: list[dict]):
+#============================================================================================================
     if store.db is not None and knowledge_source is not None:
-        store.db.executemany('replace into knowledge (source, entity, knowledge) values (?, ?, ?)',
-                            ((knowledge_source, row[0], row[1]) for row in prior_knowledge))
+        for knowledge in prior_knowledge:
+            store.store_entity_knowledge(knowledge['id'], knowledge, source=knowledge_source)
         store.db.commit()
 
+def knowledge_changed(knowledge: dict, stored_knowledge: dict) -> bool:
+#======================================================================
+    # Compare JSON encodings, ignoring the knowledge source and the order of path edges and nodes
+    return (json.loads(json.dumps(canonical_knowledge({field: value for field, value in knowledge.items()
+                                                                        if field != 'source'})))
+         != json.loads(json.dumps(canonical_knowledge({field: value for field, value in stored_knowledge.items()
+                                                                        if field != 'source'}))))
+
+def update_knowledge(store: KnowledgeStore, knowledge_source: str, previous_source: str,
+                     all_entities: list[str], commit_every: int) -> dict[str, int]:
+#======================================================================================
+    """
+    Update knowledge carried forward from a previous source, only getting knowledge from
+    SCKAN for entities that NPO has added or changed, and deleting paths it no longer has.
+
+    :returns:   Counts of ``added``, ``changed``, ``removed``, and ``unchanged`` entities
+    """
+    assert store.db is not None
+    if previous_source != knowledge_source:
+        logging.info(f'Carrying forward knowledge from `{previous_source}`')
+        store.purge_knowledge(knowledge_source)
+        store.copy_knowledge(previous_source, knowledge_source)
+        store.db.commit()
+    stored_knowledge = {knowledge['id']: knowledge for knowledge in store.source_knowledge(knowledge_source)}
+    summary = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+    progress_bar = tqdm(total=len(all_entities),
+        unit='entity', ncols=80,
+        bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}')
+    with store.bulk_load(commit_every=commit_every):
+        for entity in all_entities:
+            previous_knowledge = stored_knowledge.get(entity)
+            npo_knowledge = store.npo_knowledge(entity)
+            if previous_knowledge is None:
+                store.entity_knowledge(entity, source=knowledge_source, refresh=True)
+                summary['added'] += 1
+            elif set(npo_knowledge).issubset({'id', 'source'}):
+                # Knowledge that didn't come from NPO is carried forward
+                summary['unchanged'] += 1
+            elif knowledge_changed(npo_knowledge, previous_knowledge):
+                store.entity_knowledge(entity, source=knowledge_source, refresh=True)
+                summary['changed'] += 1
+            else:
+                summary['unchanged'] += 1
+            progress_bar.update(1)
+        # Paths and models that NPO no longer has
+        npo_entities = set(all_entities)
+        for entity, knowledge in stored_knowledge.items():
+            if (entity not in npo_entities
+            and any(field in knowledge for field in ['connectivity', 'paths'])):
+                store.delete_knowledge(entity, source=knowledge_source)
+                summary['removed'] += 1
+    progress_bar.close()
+    return summary
+
 #===============================================================================
 
 def load(args):
@@ -75,9 +128,11 @@ def load(args):
         store_directory=args.store_directory,
         knowledge_base=args.knowledge_store,
         sckan_version=args.sckan,
+        npo_path=args.npo_path,
         scicrunch_key=scicrunch_key,
         use_sckan=True,
-        verbose=False
+        verbose=False,
+        profile=SQLITE_BULK_LOAD_PROFILE
         )
     if store.db is None:
         raise IOError(f'Unable to open knowledge store {args.store_directory}/{args.knowledge_store}')
@@ -86,10 +141,27 @@ def load(args):
     logging.info(f'Loading SCKAN NPO knowledge for source `{knowledge_source}`')
     all_entities = store.entities()
 
+    if args.incremental and knowledge_source is not None:
+        sources = store.knowledge_sources()     # Ordered, most recent first
+        if knowledge_source in sources:
+            previous_source = knowledge_source
+        else:
+            previous_source = next((source for source in sources if source < knowledge_source), None)
+        if previous_source is not None:
+            summary = update_knowledge(store, knowledge_source, previous_source, all_entities, args.commit_every)
+            store.close()
+            logging.info(f"Updated knowledge for `{knowledge_source}` from `{previous_source}`: "
+                         f"{summary['added']} added, {summary['changed']} changed, "
+                         f"{summary['removed']} removed, {summary['unchanged']} unchanged")
+            if args.save_json:
+                args.source = knowledge_source
+                extract(args)
+            return
+        logging.warning(f'No earlier knowledge source to update `{knowledge_source}` from, loading all knowledge')
+
     if store.db is not None and knowledge_source is not None:
         logging.info(f'Purging all knowledge for source `{knowledge_source}`')
-        store.db.execute('delete from knowledge where source=?', (knowledge_source, ))
-        store.db.execute('delete from connectivity_nodes where source=?', (knowledge_source, ))
+        store.purge_knowledge(knowledge_source)
         store.db.commit()
 
     paths = store.connectivity_paths()
@@ -98,17 +170,18 @@ def load(args):
         bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}')
 
     path_count = 0
-    for path in paths:
-        store.entity_knowledge(path, source=knowledge_source)
-        progress_bar.update(1)
-        path_count += 1
-
-    missing_entities = set(all_entities).difference(set([row[0] for row in store.db.execute(
-        'select distinct entity from knowledge where source=?', (knowledge_source, )).fetchall()]))
-    progress_bar.update(len(all_entities) - len(missing_entities) - path_count)
-    for entity in missing_entities:
-        store.entity_knowledge(entity, source=knowledge_source)
-        progress_bar.update(1)
+    with store.bulk_load(commit_every=args.commit_every):
+        for path in paths:
+            store.entity_knowledge(path, source=knowledge_source)
+            progress_bar.update(1)
+            path_count += 1
+
+        missing_entities = set(all_entities).difference(set([row[0] for row in store.db.execute(
+            'select distinct entity from knowledge where source=?', (knowledge_source, )).fetchall()]))
+        progress_bar.update(len(all_entities) - len(missing_entities) - path_count)
+        for entity in missing_entities:
+            store.entity_knowledge(entity, source=knowledge_source)
+            progress_bar.update(1)
 
     store.close()
     progress_bar.close()
@@ -138,10 +211,7 @@ def extract(args):
         'source': knowledge_source,
         'knowledge': []
     }
-    for row in store.db.execute('select entity, knowledge from knowledge where source=?', (knowledge_source,)).fetchall():
-        knowledge = json.loads(row[1])
-        knowledge['id'] = row[0]
-        saved_knowledge['knowledge'].append(knowledge)
+    saved_knowledge['knowledge'].extend(store.source_knowledge(knowledge_source))
     store.close()
 
     json_file = Path(args.store_directory) / f'{knowledge_source}.json'
@@ -151,13 +221,33 @@ def extract(args):
 
 #===============================================================================
 
+def snapshot(args):
+    store = KnowledgeStore(
+        store_directory=args.store_directory,
+        knowledge_base=args.knowledge_store,
+        read_only=True,
+        knowledge_source=args.source)
+    if store.db is None:
+        raise IOError(f'Unable to open knowledge store {args.store_directory}/{args.knowledge_store}')
+    knowledge_source = store.source
+    if knowledge_source is None:
+        raise ValueError(f'No valid knowledge sources in {args.store_directory}/{args.knowledge_store}')
+    snapshot_file = (Path(args.output) if args.output is not None
+                     else Path(args.store_directory) / f'{knowledge_source}{SNAPSHOT_SUFFIX}')
+    count = export_snapshot(store, snapshot_file, knowledge_source)
+    store.close()
+    logging.info(f'Saved {count} records for `{knowledge_source}` to snapshot `{snapshot_file}`')
+
+#===============================================================================
+
 def restore(args):
     with open(args.json_file) as fp:
         saved_knowledge = json.load(fp)
     store = KnowledgeStore(
         store_directory=args.store_directory,
         knowledge_base=args.knowledge_store,
-        use_sckan=False)
+        use_sckan=False,
+        profile=SQLITE_BULK_LOAD_PROFILE)
     if store.db is None:
         raise IOError(f'Unable to open knowledge store {args.store_directory}/{args.knowledge_store}')
 
@@ -166,27 +256,15 @@ def restore(args):
     if args.purge:
         if store.db is not None and knowledge_source is not None:
             logging.info(f'Purging all knowledge for source `{knowledge_source}`')
-            store.db.execute('delete from knowledge where source=?', (knowledge_source, ))
-            store.db.execute('delete from connectivity_nodes where source=?', (knowledge_source, ))
+            store.purge_knowledge(knowledge_source)
             store.db.commit()
         prior_knowledge = []
     else:
         prior_knowledge = get_prior_knowledge(store, knowledge_source)
 
-    for knowledge in saved_knowledge['knowledge']:
-        entity = knowledge['id']
-        store.db.execute('replace into knowledge (source, entity, knowledge) values (?, ?, ?)',
-                                             (knowledge_source, entity, json.dumps(knowledge)))
-        if 'connectivity' in knowledge:
-            seen_nodes = set()
-            for edge in knowledge['connectivity']:
-                for node in edge:
-                    node = (node[0], tuple(node[1]))
-                    if node not in seen_nodes:
-                        seen_nodes.add(node)
-                        store.db.execute('insert into connectivity_nodes (source, node, path) values (?, ?, ?)',
-                                                                    (knowledge_source, json.dumps(node), entity))
-    store.db.commit()
+    with store.bulk_load(commit_every=args.commit_every):
+        for knowledge in saved_knowledge['knowledge']:
+            store.store_entity_knowledge(knowledge['id'], knowledge, source=knowledge_source)
 
     save_prior_knowledge(store, knowledge_source, prior_knowledge)
 
@@ -207,6 +285,66 @@ def info(args):
 
 #===============================================================================
 
+def deploy_knowledge(store: KnowledgeStore, knowledge_source: str, deploy_file: Path) -> int:
+#============================================================================================
+    """
+    Save a compacted and analysed copy of a store, with only the knowledge of one
+    source, ready for servers to open read only.
+
+    :returns:   The number of entities in the deployed store
+    """
+    temp_file = deploy_file.with_name(f'{deploy_file.name}.{os.getpid()}.tmp')
+    temp_file.unlink(missing_ok=True)
+    try:
+        store.vacuum_into(temp_file)
+        deployed = KnowledgeStore(
+            store_directory=temp_file.parent,
+            knowledge_base=temp_file.name,
+            create=False,
+            use_sckan=False,
+            verbose=False,
+            profile=SQLITE_BULK_LOAD_PROFILE)
+        assert deployed.db is not None
+        # Sources are as saved, rather than as cleaned by ``knowledge_sources()``
+        sources = set()
+        for table in ['knowledge', 'connectivity_nodes', 'connectivity_terms', 'unknown_entities']:
+            sources.update(row[0] for row in deployed.db.execute(f'select distinct source from {table}')
+                                        if row[0] is not None)
+        for source in sources - {knowledge_source}:
+            deployed.purge_knowledge(source)
+        deployed.db.commit()
+        count = deployed.db.execute('select count(*) from knowledge where source=?',
+                                                                (knowledge_source,)).fetchone()[0]
+        deployed.set_metadata('deployed-source', knowledge_source)
+        deployed.set_metadata('deployed-entities', str(count))
+        deployed.set_metadata('deployed-at', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+        deployed.optimise()
+        deployed.close()
+        os.replace(temp_file, deploy_file)
+    finally:
+        temp_file.unlink(missing_ok=True)
+    return count
+
+def deploy(args):
+    store = KnowledgeStore(
+        store_directory=args.store_directory,
+        knowledge_base=args.knowledge_store,
+        read_only=True,
+        use_sckan=False,
+        knowledge_source=args.source)
+    if store.db is None:
+        raise IOError(f'Unable to open knowledge store {args.store_directory}/{args.knowledge_store}')
+    knowledge_source = store.source
+    if knowledge_source is None:
+        raise ValueError(f'No valid knowledge sources in {args.store_directory}/{args.knowledge_store}')
+    deploy_file = (Path(args.output) if args.output is not None
+                   else Path(args.store_directory) / f'{knowledge_source}.db')
+    count = deploy_knowledge(store, knowledge_source, deploy_file)
+    store.close()
+    logging.info(f'Deployed {count} records for `{knowledge_source}` to `{deploy_file}`')
+
+#===============================================================================
+
 def upgrade(args):
     store = KnowledgeStore(
         store_directory=args.store_directory,
@@ -227,18 +365,33 @@ def main():
     parser.add_argument('--knowledge-store', default=DEFAULT_STORE, help=f'Name of knowledge store file. Defaults to `{DEFAULT_STORE}`')
     parser.add_argument('-d', '--debug', action='store_true', help='Show DEBUG log messages')
     parser.add_argument('-q', '--quiet', action='store_true', help='Suppress INFO log messages')
+    parser.add_argument('--commit-every', type=int, default=BULK_LOAD_COMMIT_EVERY,
+                        help=f'Number of entities to save between commits when loading knowledge. Defaults to {BULK_LOAD_COMMIT_EVERY}')
 
     subparsers = parser.add_subparsers(title='commands', required=True)
 
     parser_load = subparsers.add_parser('load', help='Flush and load all knowledge from SCKAN NPO into a local knowledge store.')
     parser_load.add_argument('--sckan', help='SCKAN release identifier; defaults to latest available version of SCKAN')
+    parser_load.add_argument('--npo-path', help='Load the SCKAN release from a NIF-Ontology checkout, or a directory of its TTL files, instead of from GitHub.')
     parser_load.add_argument('--save-json', action='store_true', help='Optionally save knowledge as JSON in the store directory.')
+    parser_load.add_argument('--incremental', action='store_true',
+                             help='Carry forward knowledge from the previous source and only load entities that have changed.')
     parser_load.set_defaults(func=load)
 
     parser_extract = subparsers.add_parser('extract', help='Save knowledge from a local store as JSON in the store directory.')
     parser_extract.add_argument('--source', help='Knowledge source to extract; defaults to the most recent source in the store.')
     parser_extract.set_defaults(func=extract)
 
+    parser_snapshot = subparsers.add_parser('snapshot', help='Save knowledge from a local store as a read-only snapshot file.')
+    parser_snapshot.add_argument('--source', help='Knowledge source to save; defaults to the most recent source in the store.')
+    parser_snapshot.add_argument('--output', help=f'Snapshot file to create; defaults to `SOURCE{SNAPSHOT_SUFFIX}` in the store directory.')
+    parser_snapshot.set_defaults(func=snapshot)
+
+    parser_deploy = subparsers.add_parser('deploy', help='Save a compacted copy of a local store, with only one knowledge source, for servers.')
+    parser_deploy.add_argument('--source', help='Knowledge source to deploy; defaults to the most recent source in the store.')
+    parser_deploy.add_argument('--output', help='Database file to create; defaults to `SOURCE.db` in the store directory.')
+    parser_deploy.set_defaults(func=deploy)
+
     parser_info = subparsers.add_parser('info', help='List knowledge sources in a local store.')
     parser_info.set_defaults(func=info)
 